@@ -0,0 +1,79 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# engines.py - Compares the DSP engines on a generated track.
+#
+# python3 -m bench.engines [--seconds 180] [--runs 3]
+
+
+from argparse import ArgumentParser
+import io
+import resource
+import subprocess
+from time import perf_counter, process_time
+
+from ncconv.config import DEFAULT_PITCH, DEFAULT_TEMPO, FFMPEG_EXEC
+from ncconv.ffconv import FFmpegEngine
+
+
+def _track(seconds: int) -> bytes:
+    '''
+    A stereo wav file with a chord and some noise, so that neither engine gets an easy ride.
+    '''
+    return subprocess.run((FFMPEG_EXEC, '-v', 'error', '-f', 'lavfi', '-i',
+                           f'aevalsrc=0.2*sin(2*PI*220*t)+0.2*sin(2*PI*277*t)+0.2*sin(2*PI*330*t)|0.2*sin(2*PI*165*t)+0.1*sin(2*PI*440*t):s=44100:d={seconds}',
+                           '-f', 'lavfi', '-i', f'anoisesrc=a=0.05:c=pink:r=44100:d={seconds}',
+                           '-filter_complex', 'amix=inputs=2:normalize=0', '-ac', '2', '-f', 'wav', 'pipe:1'),
+                          capture_output=True, check=True).stdout
+
+
+def _cpu() -> float:
+    # ffmpeg runs in child processes, the numpy engine in this one
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return process_time() + children.ru_utime + children.ru_stime
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python3 -m bench.engines',
+                            description='Compares the DSP engines on a generated track.')
+    parser.add_argument('--seconds', type=int, default=180,
+                        help='Length of the track (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Conversions per engine (default: %(default)s)')
+    parser.add_argument('--format', default='m4a', choices=('m4a', 'ogg'),
+                        help='Output format (default: %(default)s)')
+    parser.add_argument('--frame', type=int, action='append',
+                        help='Frame size for the numpy engine, may be given more than once (default: 2048)')
+    args = parser.parse_args()
+
+    track = _track(args.seconds)
+    engines = [('ffmpeg', FFmpegEngine())]
+
+    try:
+        from ncconv.dsp import NumpyEngine
+        engines += [(f'numpy (frame {frame})', NumpyEngine(frame=frame))
+                    for frame in args.frame or [2048]]
+    except ImportError:
+        print('numpy and scipy are not installed, only benchmarking ffmpeg.')
+
+    print(f'{args.seconds} s of audio, {args.runs} runs each, to {args.format}')
+    print(f'{"engine":<24}{"wall (s)":>10}{"cpu (s)":>10}{"x realtime":>12}{"size (KiB)":>12}')
+
+    for name, engine in engines:
+        wall = cpu = 0
+
+        for _ in range(args.runs):
+            out = io.BytesIO()
+            started, cpu_started = perf_counter(), _cpu()
+            engine.convert(io.BytesIO(track), {args.format: out}, DEFAULT_TEMPO, DEFAULT_PITCH,
+                           'wav', 44100, 0, None)
+            wall += perf_counter() - started
+            cpu += _cpu() - cpu_started
+
+        wall, cpu = wall / args.runs, cpu / args.runs
+        print(f'{name:<24}{wall:>10.2f}{cpu:>10.2f}{args.seconds / wall:>12.1f}{len(out.getvalue()) / 1024:>12.0f}')
@@ -0,0 +1,289 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# ffconv.py - Benchmarks probing and converting generated tracks, and compares
+# the results of two runs.
+#
+# python3 -m bench.ffconv -o before.json
+# python3 -m bench.ffconv -o after.json
+# python3 -m bench.ffconv --compare before.json after.json
+
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from itertools import product
+import multiprocessing
+import os
+import platform
+import resource
+from statistics import median
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from orjson import dumps as json_dumps, loads as json_loads, OPT_INDENT_2
+
+from ncconv.config import DEFAULT_PITCH, DEFAULT_TEMPO, FFMPEG_EXEC
+from ncconv.ffconv import _probe_audio, convert_audio
+
+
+# input format -> (container, codec)
+_codecs = {
+    'wav': ('wav', 'pcm_s16le'),
+    'flac': ('flac', 'flac'),
+    'mp3': ('mp3', 'libmp3lame'),
+    'ogg': ('ogg', 'libvorbis'),
+    'opus': ('ogg', 'libopus')
+}
+
+# lavfi sources
+_signals = {
+    'sine': 'sine=frequency=440:sample_rate={rate}:duration={duration}',
+    'noise': 'anoisesrc=color=pink:amplitude=0.3:sample_rate={rate}:duration={duration}'
+}
+
+
+class _Sink:
+    '''
+    Counts what is written to it instead of keeping it, so that memory use is ffconv's own.
+    '''
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, buf: bytes):
+        self.size += len(buf)
+
+
+def _fixtures(directory: str, signals: List[str], inputs: List[str], durations: List[int], rates: List[int]) -> List[dict]:
+    '''
+    Generates every combination of the fixture parameters into directory, unless it is already there.
+    '''
+    fixtures = {}
+
+    for signal, input_format, duration, rate in product(signals, inputs, durations, rates):
+        # opus doesn't do 44.1 kHz
+        if input_format == 'opus':
+            rate = 48000
+
+        path = os.path.join(
+            directory, f'{signal}-{duration}s-{rate}.{input_format}')
+
+        if path not in fixtures:
+            if not os.path.exists(path):
+                container, codec = _codecs[input_format]
+                subprocess.run((FFMPEG_EXEC, '-v', 'error', '-y', '-f', 'lavfi', '-i',
+                                _signals[signal].format(rate=rate, duration=duration), '-ac', '2', '-c:a', codec,
+                                '-f', container, path), check=True)
+
+            fixtures[path] = {'path': path, 'signal': signal, 'format': input_format, 'duration': duration,
+                              'sample_rate': rate, 'size': os.path.getsize(path)}
+
+    return list(fixtures.values())
+
+
+def _child(conn, target: Callable[..., dict], args: tuple):
+    try:
+        started = perf_counter()
+        extra = target(*args)
+        wall = perf_counter() - started
+
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        conn.send({
+            'wall': wall,
+            # ffmpeg and ffprobe are waited for, so their time is counted in children
+            'cpu': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            'maxrss_kib': own.ru_maxrss,
+            'ffmpeg_maxrss_kib': children.ru_maxrss,
+            **extra
+        })
+    except Exception as e:
+        conn.send({'error': repr(e)})
+
+
+def _isolated(target: Callable[..., dict], *args) -> dict:
+    '''
+    Runs target in a fresh process, so that peak RSS and CPU time belong to this call alone.
+    '''
+    ctx = multiprocessing.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(send, target, args))
+    proc.start()
+    send.close()
+
+    try:
+        return recv.recv()
+    finally:
+        proc.join()
+
+
+def _probe(path: str) -> dict:
+    with open(path, 'rb') as f:
+        probed = _probe_audio(f)
+
+    return {'probed_format': probed.format, 'probed_sample_rate': probed.sample_rate}
+
+
+def _encode(path: str, output_format: str, tempo: float, pitch: float, input_format: str, sample_rate: int, threads: int) -> dict:
+    sink = _Sink()
+
+    with open(path, 'rb') as f:
+        convert_audio(f, sink, output_format, tempo, pitch,
+                      input_format, sample_rate, threads)
+
+    return {'output_size': sink.size}
+
+
+def _summarize(runs: List[dict]) -> dict:
+    '''
+    Medians of the measurements over repeated runs, and the rest of the first run.
+    '''
+    if any('error' in run for run in runs):
+        return next(run for run in runs if 'error' in run)
+
+    summary = dict(runs[0])
+    for key in ('wall', 'cpu', 'maxrss_kib', 'ffmpeg_maxrss_kib'):
+        summary[key] = median(run[key] for run in runs)
+
+    return summary
+
+
+def _case_key(result: dict) -> tuple:
+    fixture = result['fixture']
+    return (result['stage'], fixture['signal'], fixture['format'], fixture['duration'], fixture['sample_rate'],
+            result.get('output_format'), result.get('tempo'), result.get('pitch'))
+
+
+def _compare(before_path: str, after_path: str, threshold: float):
+    '''
+    Prints how each case changed between two runs, flagging changes larger than threshold.
+    '''
+    with open(before_path, 'rb') as f:
+        before = {_case_key(r): r for r in json_loads(f.read())['results']}
+    with open(after_path, 'rb') as f:
+        after = {_case_key(r): r for r in json_loads(f.read())['results']}
+
+    print(f'{"case":<58}{"wall":>9}{"cpu":>9}{"rss":>9}')
+    regressions = 0
+
+    for key in sorted(before.keys() & after.keys(), key=str):
+        old, new = before[key], after[key]
+        if 'error' in old or 'error' in new:
+            print(f'{" ".join(map(str, key)):<58}   error')
+            continue
+
+        ratios = [new[m] / old[m] if old[m] else 1.0 for m in (
+            'wall', 'cpu', 'maxrss_kib')]
+        flag = ' <-' if any(r > 1 + threshold for r in ratios) else ''
+        regressions += bool(flag)
+
+        print(f'{" ".join(str(k) for k in key if k is not None):<58}' +
+              ''.join(f'{r:>8.2f}x' for r in ratios) + flag)
+
+    print(f'{regressions} of {len(before.keys() & after.keys())} cases got more than {threshold:.0%} worse')
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(('git', 'rev-parse', 'HEAD'), capture_output=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ffmpeg_version() -> str:
+    return subprocess.run((FFMPEG_EXEC, '-version'), capture_output=True).stdout.decode().partition('\n')[0]
+
+
+def _list(cast: Callable) -> Callable[[str], list]:
+    return lambda value: [cast(v) for v in value.split(',')]
+
+
+def _combos(value: str) -> List[tuple]:
+    # tempo:pitch,tempo:pitch
+    return [tuple(float(x) for x in combo.split(':')) for combo in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python3 -m bench.ffconv',
+                            description='Benchmarks probing and converting generated tracks.')
+    parser.add_argument('-o', '--output', help='Where to write the results as JSON (default: stdout)')
+    parser.add_argument('--fixtures', help='Where to keep the generated tracks (default: a temporary directory)')
+    parser.add_argument('--signals', type=_list(str), default=list(_signals),
+                        help='Comma separated, from sine,noise (default: all)')
+    parser.add_argument('--inputs', type=_list(str), default=list(_codecs),
+                        help='Comma separated, from wav,flac,mp3,ogg,opus (default: all)')
+    parser.add_argument('--durations', type=_list(int), default=[10, 60],
+                        help='Comma separated lengths in seconds (default: 10,60)')
+    parser.add_argument('--rates', type=_list(int), default=[44100, 48000],
+                        help='Comma separated sample rates (default: 44100,48000)')
+    parser.add_argument('--outputs', type=_list(str), default=['m4a', 'ogg'],
+                        help='Comma separated output formats (default: m4a,ogg)')
+    parser.add_argument('--combos', type=_combos, default=[(DEFAULT_TEMPO, DEFAULT_PITCH), (1.0, 1.0), (2.5, 1.5)],
+                        help=f'Comma separated tempo:pitch pairs (default: {DEFAULT_TEMPO}:{DEFAULT_PITCH},1:1,2.5:1.5)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Threads per conversion, 0 lets ffmpeg decide (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per case, the median is reported (default: 3)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two result files instead of running the benchmark')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='With --compare, flag cases that got this much worse (default: 0.1)')
+    args = parser.parse_args()
+
+    if args.compare:
+        _compare(*args.compare, args.threshold)
+        sys.exit(0)
+
+    fixtures = _fixtures(args.fixtures or mkdtemp(prefix='ncconv-bench-'), args.signals,
+                         args.inputs, args.durations, args.rates)
+    results = []
+
+    for fixture in fixtures:
+        probed = _summarize([_isolated(_probe, fixture['path'])
+                            for _ in range(args.repeat)])
+        results.append({'stage': 'probe', 'fixture': fixture, **probed})
+        print(f'probe  {os.path.basename(fixture["path"])}: {probed.get("wall", 0):.3f}s', file=sys.stderr)
+
+        if 'error' in probed:
+            continue
+
+        for output_format, (tempo, pitch) in product(args.outputs, args.combos):
+            encoded = _summarize([_isolated(_encode, fixture['path'], output_format, tempo, pitch, probed['probed_format'],
+                                            probed['probed_sample_rate'], args.threads) for _ in range(args.repeat)])
+            results.append({'stage': 'encode', 'fixture': fixture, 'output_format': output_format,
+                            'tempo': tempo, 'pitch': pitch, **encoded})
+            print(f'encode {os.path.basename(fixture["path"])} -> {output_format} {tempo}:{pitch}: '
+                  f'{encoded.get("wall", 0):.3f}s', file=sys.stderr)
+
+    report: Dict = {
+        'meta': {
+            'commit': _git_commit(),
+            'time': datetime.now(timezone.utc).isoformat(),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'ffmpeg': _ffmpeg_version(),
+            'cpu_count': os.cpu_count(),
+            'threads': args.threads,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+
+    out = json_dumps(report, option=OPT_INDENT_2)
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(out)
+    else:
+        sys.stdout.buffer.write(out + b'\n')
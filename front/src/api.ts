@@ -14,10 +14,17 @@ interface StatusCallback {
     (message: string): void;
 }
 
+interface EnqueueResponse {
+    task_id: string;
+    estimated_wait?: number;
+}
+
 interface CheckResponse {
     complete: boolean;
     position?: number;
+    progress?: number;
     file_id?: string;
+    file_ids?: string[];
 }
 
 export async function convert_audio(file: File, format: string, scale_pitch: number, scale_tempo: number, status_cb: StatusCallback): Promise<string> {
@@ -44,7 +51,48 @@ export async function convert_audio(file: File, format: string, scale_pitch: num
     }
 
     if (j.hasOwnProperty('task_id')) {
-        return await wait_for_completion(j['task_id'], status_cb);
+        let obj = j as EnqueueResponse;
+        // When the server expects a worker to start on it, counted down from while it waits
+        let start_at = obj.estimated_wait ? Date.now() + obj.estimated_wait * 1000 : undefined;
+
+        return await wait_for_events(obj.task_id, status_cb, start_at);
+    } else if (j.hasOwnProperty('detail')) {
+        throw j['detail'];
+    } else {
+        throw t;
+    }
+}
+
+/*
+    Converts the start of a file at a low bitrate, without waiting in the queue. Returns once the start of it is ready,
+    with a URL that streams the rest while it is converted. Point an audio element at it to play it as it comes in.
+    It can only be played once.
+*/
+export async function preview_audio(file: File, format: string, scale_pitch: number, scale_tempo: number): Promise<string> {
+    let b = new FormData();
+    b.append('output_format', format);
+    b.append('scale_pitch', scale_pitch.toString());
+    b.append('scale_tempo', scale_tempo.toString());
+    b.append('audio_file', file);
+
+    let resp = await fetch('/api/convert/preview', {
+        method: 'post',
+        mode: 'cors',
+        redirect: 'follow',
+        body: b
+    })
+
+    let t = await resp.text();
+    let j;
+
+    try {
+        j = JSON.parse(t);
+    } catch (e) {
+        throw `Unexpected Response: ${t}.`;
+    }
+
+    if (j.hasOwnProperty('task_id')) {
+        return `/api/convert/preview/${encodeURIComponent((j as EnqueueResponse).task_id)}`;
     } else if (j.hasOwnProperty('detail')) {
         throw j['detail'];
     } else {
@@ -52,7 +100,57 @@ export async function convert_audio(file: File, format: string, scale_pitch: num
     }
 }
 
-async function wait_for_completion(task_id: string, status_cb: StatusCallback): Promise<string> {
+function report_status(obj: CheckResponse, status_cb: StatusCallback, start_at?: number) {
+    let minutes = start_at ? Math.ceil((start_at - Date.now()) / 60000) : 0;
+
+    // with several workers, jobs further down the line may be converting already
+    if (obj.progress !== undefined) {
+        status_cb(`Converting ${Math.floor(obj.progress)}%`);
+    } else if (obj.position && obj.position <= 1) {
+        status_cb("Converting");
+    } else if (minutes > 0) {
+        status_cb(`${obj.position - 1} Ahead, about ${minutes} min`);
+    } else {
+        status_cb(`${obj.position - 1} Ahead`);
+    }
+}
+
+/*
+    Follows the task through the server-sent event stream, falling back to polling if the stream can't be used.
+*/
+function wait_for_events(task_id: string, status_cb: StatusCallback, start_at?: number): Promise<string> {
+    if (typeof EventSource === 'undefined') {
+        return wait_for_completion(task_id, status_cb, start_at);
+    }
+
+    return new Promise((resolve, reject) => {
+        let es = new EventSource(`/api/convert/events/${task_id}`);
+
+        es.addEventListener('status', (e: MessageEvent) => {
+            let obj = JSON.parse(e.data) as CheckResponse;
+
+            if (obj.complete && obj.file_id) {
+                es.close();
+                resolve(obj.file_id);
+            } else {
+                report_status(obj, status_cb, start_at);
+            }
+        });
+
+        es.addEventListener('failed', (e: MessageEvent) => {
+            es.close();
+            reject(JSON.parse(e.data)['detail']);
+        });
+
+        // The connection was lost or refused
+        es.onerror = () => {
+            es.close();
+            wait_for_completion(task_id, status_cb, start_at).then(resolve, reject);
+        };
+    });
+}
+
+async function wait_for_completion(task_id: string, status_cb: StatusCallback, start_at?: number): Promise<string> {
     while (true) {
         let resp = await fetch(`/api/convert/check?task_id=${task_id}`)
         let t = await resp.text();
@@ -70,10 +168,8 @@ async function wait_for_completion(task_id: string, status_cb: StatusCallback):
 
             if (obj.complete && obj.file_id) {
                 return obj.file_id;
-            } else if (obj.position && obj.position <= 1) {
-                status_cb("Converting");
             } else {
-                status_cb(`${obj.position - 1} Ahead`);
+                report_status(obj, status_cb, start_at);
             }
         } else if (j.hasOwnProperty('detail')) {
             throw j['detail'];
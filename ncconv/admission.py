@@ -0,0 +1,125 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# admission.py - Estimates how long new jobs would wait for a worker, so that
+# uploads can be refused before they are stored when the queue is too long.
+
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+import math
+from typing import Optional
+
+from fastapi import HTTPException
+
+from ncconv.config import LEASE_DURATION
+from ncconv.metrics import ADMISSION_REJECTIONS
+from ncconv.queuepos import QueueSnapshot
+from ncconv.steps import Steps
+
+
+# How much each finished job moves the service time estimate of its pool
+_ALPHA = 0.1
+
+
+def record_service_time(db, pool: str, seconds: float) -> Steps[None]:
+    '''
+    Adds a finished job to the service time estimate of a pool. Never raises, the estimate is only advisory.
+    A step generator (see steps.py).
+
+    :param db: Database reference
+    :param pool: convert or preview
+    :param seconds: How long the job took per unit of work. Conversions are measured per second of audio and output
+                    format (see queuepos.job_work), previews per job since they are all the same length.
+    '''
+    try:
+        # an exponentially weighted moving average, in one atomic update
+        yield db.servicetime.update_one({'_id': pool}, [{'$set': {'seconds': {'$add': [
+            {'$multiply': [1 - _ALPHA, {'$ifNull': ['$seconds', seconds]}]},
+            _ALPHA * seconds
+        ]}}}], upsert=True)
+    except Exception as e:
+        print(e)
+
+
+def announce_workers(db, owner: str, workers: int, preview_workers: int) -> Steps[None]:
+    '''
+    Tells the HTTP server how many workers this process runs, so that it can tell how fast the queue goes down.
+    Has to be repeated more often than every LEASE_DURATION seconds. A step generator.
+
+    :param db: Database reference
+    :param owner: Identifies the process
+    :param workers: How many conversions it runs at the same time
+    :param preview_workers: How many previews it runs at the same time
+    '''
+    try:
+        yield db.workers.update_one({'_id': owner}, {'$set': {
+            'convert': workers,
+            'preview': preview_workers,
+            # forgotten if the process stops announcing itself without withdrawing
+            'expires': datetime.now(timezone.utc) + timedelta(seconds=LEASE_DURATION)
+        }}, upsert=True)
+    except Exception as e:
+        print(e)
+
+
+async def estimated_wait(db, snapshot: QueueSnapshot, pool: str, before: Optional[datetime] = None) -> Optional[float]:
+    '''
+    Returns about how many seconds a job enqueued now would wait for a worker of a pool to start on it, or None
+    if that can't be told, because no worker of the pool has announced itself or finished a job yet.
+
+    The jobs ahead of it are added up in units of work, and divided between the workers at the pool's average
+    service time. It doesn't wait at all if there are fewer jobs ahead of it than workers. The jobs are taken from
+    the snapshot of the queue, so that uploads don't look through the queue each.
+
+    :param db: Database reference (Motor)
+    :param snapshot: The queue snapshot
+    :param pool: convert or preview
+    :param before: The job's sched_time. Jobs queued after it don't hold it up. All of them do if None
+    '''
+    now = datetime.now(timezone.utc)
+
+    estimate, workers, (jobs, work) = await asyncio.gather(
+        db.servicetime.find_one({'_id': pool}),
+        db.workers.aggregate([
+            {'$match': {'expires': {'$gt': now}}},
+            {'$group': {'_id': None, 'workers': {'$sum': f'${pool}'}}}
+        ]).to_list(None),
+        snapshot.ahead(db, pool, before))
+
+    workers = workers[0]['workers'] if workers else 0
+
+    if not estimate or not workers:
+        return None
+
+    if jobs < workers:
+        return 0.0
+
+    return work * estimate['seconds'] / workers
+
+
+async def admit(db, snapshot: QueueSnapshot, pool: str, max_wait: float, before: Optional[datetime] = None) -> Optional[float]:
+    '''
+    Refuses a job with 503 if it would wait for longer than max_wait seconds, telling the client to come back once
+    the queue should have gone down far enough. Otherwise, returns the estimated_wait of the job.
+
+    :param db: Database reference (Motor)
+    :param snapshot: as for estimated_wait
+    :param pool: convert or preview
+    :param max_wait: The longest wait that is accepted. 0 accepts any
+    :param before: as for estimated_wait
+    '''
+    wait = await estimated_wait(db, snapshot, pool, before)
+    if max_wait and wait is not None and wait > max_wait:
+        ADMISSION_REJECTIONS.labels(pool).inc()
+        # nothing else being enqueued meanwhile, the wait goes down by a second every second
+        secs = f'{max(1, int(math.ceil(wait - max_wait)))}'
+        raise HTTPException(status_code=503, detail=f'The queue is full right now. Try again in {secs} seconds!', headers={
+                            'Retry-After': secs})
+
+    return wait
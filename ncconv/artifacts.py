@@ -0,0 +1,100 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# artifacts.py - Keeps the metadata of recently requested artifacts in memory.
+# Artifacts never change once written, except for how long they are kept.
+
+
+from collections import OrderedDict
+import asyncio
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Dict, Optional
+
+from bson import ObjectId
+
+
+class ArtifactCache:
+    '''
+    LRU cache of music.files documents of converted files, which are dropped once they expire.
+
+    Only finished artifacts are cached. Pending uploads are deleted soon after they are written.
+
+    The conversion cache pushes back the expire_time of an artifact that is converted again, in whichever process
+    converts it, and counts a hit in stats.conversion_cache. Whether there were hits since is checked at most every
+    check_interval seconds, which is a single lookup by _id. If there were, the expire_time of each document that was
+    cached before is read again the next time it is asked for. The same happens when it seems to have expired.
+
+    Must be created on the event loop that uses it.
+    '''
+
+    def __init__(self, size: int, check_interval: float):
+        self.size = size
+        self.check_interval = check_interval
+        # file id -> files document, and the value of stats.conversion_cache.hits when its expire_time was read
+        self.docs: 'OrderedDict[ObjectId, dict]' = OrderedDict()
+        self.hits: Dict[ObjectId, int] = {}
+        self.generation = None
+        self.checked = None
+        self.lock = asyncio.Lock()
+
+    async def get(self, db, file_id: ObjectId) -> Optional[dict]:
+        '''
+        Returns the files document of an artifact, or None if it doesn't exist or has expired.
+
+        :param db: Database reference
+        :param file_id: The artifact's _id
+        '''
+
+        if self.checked is None or monotonic() - self.checked >= self.check_interval:
+            async with self.lock:
+                # someone else may have checked while we waited
+                if self.checked is None or monotonic() - self.checked >= self.check_interval:
+                    stats = await db.stats.find_one({'_id': 'conversion_cache'}, {'hits': 1})
+                    self.generation = stats.get('hits', 0) if stats else 0
+                    self.checked = monotonic()
+
+        # read before the query, so that a hit while it runs is picked up next time
+        generation = self.generation
+
+        if (doc := self.docs.get(file_id)):
+            if self.hits[file_id] == generation and doc['metadata']['expire_time'] > datetime.now(timezone.utc):
+                self.docs.move_to_end(file_id)
+                return doc
+
+            fi = await db.music.files.find_one({'_id': file_id}, {'metadata.expire_time': 1})
+
+            if fi and (expire_time := fi['metadata']['expire_time'].replace(tzinfo=timezone.utc)) > datetime.now(timezone.utc):
+                doc['metadata']['expire_time'] = expire_time
+                self.hits[file_id] = generation
+                self.docs.move_to_end(file_id)
+                return doc
+
+            del self.docs[file_id]
+            del self.hits[file_id]
+
+            return None
+
+        doc = await db.music.files.find_one({'_id': file_id, 'metadata.pending': {'$in': [None, False]}, 'metadata.preview': {'$ne': True}})
+
+        if not doc:
+            return None
+
+        # Motor does not restore the timezone attributes for datetime objects
+        doc['metadata']['expire_time'] = doc['metadata']['expire_time'].replace(
+            tzinfo=timezone.utc)
+
+        if self.size > 0:
+            self.docs[file_id] = doc
+            self.hits[file_id] = generation
+
+            while len(self.docs) > self.size:
+                evicted, _ = self.docs.popitem(last=False)
+                del self.hits[evicted]
+
+        return doc
@@ -0,0 +1,355 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# aworkers.py - ffmpeg workers that share one event loop. Selected with
+# WORKER_ENGINE=asyncio, otherwise cworkers.py does the converting.
+
+
+import asyncio
+from contextlib import suppress
+from queue import Empty, SimpleQueue
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Set
+
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo.errors import OperationFailure
+import sentry_sdk
+
+from ncconv.admission import announce_workers
+from ncconv.config import (DSP_ENGINE, FFMPEG_THREADS, FFMPEG_WORKERS, LEASE_DURATION, MONGO_DB, MONGO_URI, PREVIEW_SECONDS,
+                           PREVIEW_WORKERS, QUEUE_POLL_INTERVAL, SENTRY_DSN)
+from ncconv.diskstore import DiskStore, disk_store
+from ncconv.ffconv import convert_audio_outputs_async
+from ncconv.jobs import (PREVIEW_HEARTBEAT, CpuBudget, Job, PreviewJob, PreviewWriter, TimedWriter, claim_next, extend_lease,
+                         fail_stuck_jobs, job_claim, lease_owner, no_change_streams, preview_claim, progress_reporter)
+from ncconv.metrics import WORKERS
+from ncconv.reaper import reap
+from ncconv.steps import Steps, run_steps_async
+
+
+def afftask(q: SimpleQueue, db=None, workers: int = FFMPEG_WORKERS, threads: int = FFMPEG_THREADS,
+            preview_workers: int = PREVIEW_WORKERS, reaper: bool = False):
+    '''
+    Same as fftask, but every conversion runs on one event loop in this thread, rather than in a thread of its own.
+    ffmpeg is run as an asyncio subprocess, and MongoDB and GridFS are used through Motor.
+
+    The nightcore transform is always done by ffmpeg's filters, since the numpy DSP_ENGINE needs threads to run in.
+
+    :param db: Database reference (Motor). Connects to MONGO_URI if None, a client that was used on another event
+               loop can't be used here.
+    :param workers: as for fftask. May be 0 along with preview_workers, to only reap.
+    :param reaper: Whether to do what reaper_task does as well, so that no pymongo client is needed for it
+
+    Other arguments are as for fftask.
+    '''
+    if DSP_ENGINE != 'ffmpeg' and workers:
+        print(f'WARNING: DSP_ENGINE {DSP_ENGINE} is not used by WORKER_ENGINE asyncio, converting with ffmpeg.')
+
+    asyncio.run(_run(q, db, workers, threads, preview_workers, reaper))
+
+
+async def _run(q: SimpleQueue, db, workers: int, threads: int, preview_workers: int, reaper: bool):
+    if db is None:
+        db = AsyncIOMotorClient(MONGO_URI)[MONGO_DB]
+
+    bucket = AsyncIOMotorGridFSBucket(db, bucket_name='music')
+    # One permit per conversion that may be started. Taken when a job is claimed and given back when it is done.
+    idle = asyncio.Semaphore(workers)
+    preview_idle = asyncio.Semaphore(preview_workers)
+    # Set when there may be something to do: a job was enqueued or one was done
+    wake = asyncio.Event()
+    stop = asyncio.Event()
+    budget = CpuBudget(threads)
+    store = disk_store()
+    # the conversions in progress
+    jobs: Set[asyncio.Future] = set()
+    converting = workers or preview_workers
+    # watching the queue and reaping
+    background = []
+
+    if converting:
+        background.append(asyncio.ensure_future(_watch_queue(db, wake, stop)))
+
+    if reaper:
+        background.append(asyncio.ensure_future(reap(db, stop)))
+
+    WORKERS.labels('convert', 'idle').inc(workers)
+    WORKERS.labels('preview', 'idle').inc(preview_workers)
+
+    # Nothing announces that a lease has expired, so look for those every now and then
+    reclaimed = None
+    announced = None
+
+    while True:
+        try:
+            with suppress(Empty):
+                poison = q.get_nowait()
+                if poison:
+                    break
+
+            woken = await _wait(wake, 1)
+            due = reclaimed is None or monotonic() - reclaimed >= LEASE_DURATION / 2
+
+            # the timeout is only there to look at q and the leases now and then
+            if not converting or (not woken and not due):
+                continue
+
+            wake.clear()
+
+            if due:
+                reclaimed = monotonic()
+                await run_steps_async(fail_stuck_jobs(db))
+
+            # so that the HTTP server can tell how long new jobs would wait
+            if announced is None or monotonic() - announced >= LEASE_DURATION / 3:
+                announced = monotonic()
+                await run_steps_async(announce_workers(db, lease_owner, workers, preview_workers))
+
+            # Previews first, somebody is listening for them right now
+            await _claim(db, preview_idle, jobs, preview_claim,
+                         lambda doc: _preview(db, bucket, doc, preview_idle, wake))
+            await _claim(db, idle, jobs, job_claim,
+                         lambda doc: _convert(db, bucket, doc, idle, wake, budget, store))
+        except Exception as e:
+            if SENTRY_DSN:
+                sentry_sdk.capture_exception(e)
+
+            print(e)
+
+            # try again in a bit
+            wake.set()
+            await asyncio.sleep(1)
+
+    # Returns once the conversions in progress are done
+    await asyncio.gather(*jobs)
+
+    stop.set()
+    await asyncio.gather(*background)
+
+    WORKERS.labels('convert', 'idle').dec(workers)
+    WORKERS.labels('preview', 'idle').dec(preview_workers)
+
+
+async def _wait(event: asyncio.Event, timeout: float) -> bool:
+    '''
+    Waits for event to be set, for at most timeout seconds. Returns whether it was.
+    '''
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(event.wait(), timeout)
+
+    return event.is_set()
+
+
+async def _watch_queue(db, wake: asyncio.Event, stop: asyncio.Event):
+    '''
+    Same as watch_queue, with a Motor change stream.
+    '''
+    while not stop.is_set():
+        try:
+            async with db.queue.watch([{'$match': {'operationType': 'insert'}}], max_await_time_ms=1000) as stream:
+                # anything enqueued before the stream was opened would be missed otherwise
+                wake.set()
+
+                while not stop.is_set():
+                    if await stream.try_next():
+                        wake.set()
+        except OperationFailure as e:
+            if e.code in no_change_streams:
+                break
+
+            print(e)
+        except Exception as e:
+            if SENTRY_DSN:
+                sentry_sdk.capture_exception(e)
+
+            print(e)
+
+        # Jobs may have been enqueued while the stream was down
+        await _wait(stop, 1)
+        wake.set()
+
+    while not await _wait(stop, QUEUE_POLL_INTERVAL):
+        wake.set()
+
+
+async def _claim(db, idle: asyncio.Semaphore, jobs: Set[asyncio.Future], claim: Callable,
+                 start: Callable[[dict], Awaitable[None]]):
+    '''
+    Claims jobs for as long as there are permits left and jobs to be claimed, and starts converting each.
+
+    :param db: Database reference
+    :param idle: One permit per conversion that may be started, which the conversion gives back
+    :param jobs: Where the conversions in progress are kept
+    :param claim: preview_claim or job_claim
+    :param start: Converts a claimed job
+    '''
+    while not idle.locked():
+        # never waits, as it isn't locked
+        await idle.acquire()
+
+        try:
+            doc = await run_steps_async(claim_next(db, claim))
+        except BaseException:
+            idle.release()
+            raise
+
+        if not doc:
+            idle.release()
+            break
+
+        job = asyncio.ensure_future(start(doc))
+        jobs.add(job)
+        job.add_done_callback(jobs.discard)
+
+
+async def _heartbeat(db, lease: dict, interval: float = LEASE_DURATION / 3, lost: Callable[[], None] = lambda: None):
+    '''
+    Keeps extending the lease on a job until cancelled, so that other workers don't take it over while it is converted.
+
+    :param interval: How often to extend it, in seconds
+    :param lost: Called if the lease is lost
+    '''
+    while True:
+        await asyncio.sleep(interval)
+
+        if not await run_steps_async(extend_lease(db, lease)):
+            lost()
+            break
+
+
+class _TimedWriter(TimedWriter):
+    '''
+    TimedWriter for a Motor GridIn, written to with await.
+    '''
+
+    async def write(self, buf: bytes):
+        started = perf_counter()
+        await self.dst.write(buf)
+        self.seconds += perf_counter() - started
+
+        # buffered, so this hardly ever waits for the disk
+        if self.copy:
+            self.copy.write(buf)
+
+
+class _PreviewWriter(PreviewWriter):
+    '''
+    PreviewWriter for a Motor GridIn, written to with await.
+    '''
+
+    async def write(self, buf: bytes):
+        self.job.check()
+        await self.dst.write(buf)
+
+
+# progress updates that are being written, so that they aren't garbage collected before they are
+_updates: Set[asyncio.Future] = set()
+
+
+def _in_background(steps: Steps[None]):
+    update = asyncio.ensure_future(run_steps_async(steps))
+    _updates.add(update)
+    update.add_done_callback(_updates.discard)
+
+
+async def _convert(db, bucket: AsyncIOMotorGridFSBucket, doc: dict, idle: asyncio.Semaphore, wake: asyncio.Event,
+                   budget: CpuBudget, store: DiskStore):
+    '''
+    Same as what cworkers._ffworker does with a job.
+
+    :param idle: Released when the job is done
+    :param wake: Set when the job is done, so that the next one is claimed
+    '''
+    WORKERS.labels('convert', 'idle').dec()
+    WORKERS.labels('convert', 'busy').inc()
+
+    job = Job(db, bucket, doc, store, _TimedWriter)
+    heartbeat = asyncio.ensure_future(_heartbeat(db, job.lease))
+
+    try:
+        try:
+            seconds = 0
+
+            if (f := await run_steps_async(job.start())):
+                started = monotonic()
+                threads = budget.take()
+
+                try:
+                    # the probe normally happened at upload time
+                    await convert_audio_outputs_async(f, job.writers, doc['scale_tempo'], doc['scale_pitch'], doc.get('input_format'),
+                                                      doc.get('sample_rate'), threads, doc.get('duration'),
+                                                      progress_reporter(db, doc['_id'], _in_background))
+                except BaseException:
+                    # don't leave the chunks uploaded so far behind
+                    await run_steps_async(job.abort())
+                    raise
+                finally:
+                    budget.give_back(threads)
+
+                seconds = monotonic() - started
+
+            await run_steps_async(job.finish(seconds))
+        except (HTTPException, Exception) as e:
+            await run_steps_async(job.fail(e))
+            raise e
+        finally:
+            heartbeat.cancel()
+            await run_steps_async(job.close())
+    except Exception as e:
+        if SENTRY_DSN:
+            sentry_sdk.capture_exception(e)
+
+        print(e)
+    finally:
+        WORKERS.labels('convert', 'busy').dec()
+        WORKERS.labels('convert', 'idle').inc()
+
+        idle.release()
+        wake.set()
+
+
+async def _preview(db, bucket: AsyncIOMotorGridFSBucket, doc: dict, idle: asyncio.Semaphore, wake: asyncio.Event):
+    '''
+    Same as what cworkers._preview_worker does with a job.
+    '''
+    WORKERS.labels('preview', 'idle').dec()
+    WORKERS.labels('preview', 'busy').inc()
+
+    job = PreviewJob(db, bucket, doc, _PreviewWriter)
+    heartbeat = asyncio.ensure_future(_heartbeat(db, job.lease, PREVIEW_HEARTBEAT, job.lost))
+
+    try:
+        try:
+            f, writer = await run_steps_async(job.start())
+
+            try:
+                await convert_audio_outputs_async(f, {doc['output_format']: writer}, doc['scale_tempo'], doc['scale_pitch'],
+                                                  doc['input_format'], doc['sample_rate'], 1, preview=PREVIEW_SECONDS)
+            except BaseException:
+                await run_steps_async(job.abort())
+                raise
+
+            await run_steps_async(job.finish())
+        except (HTTPException, Exception) as e:
+            await run_steps_async(job.fail(e))
+            raise e
+        finally:
+            heartbeat.cancel()
+            await run_steps_async(job.close())
+    except Exception as e:
+        if SENTRY_DSN:
+            sentry_sdk.capture_exception(e)
+
+        print(e)
+    finally:
+        WORKERS.labels('preview', 'busy').dec()
+        WORKERS.labels('preview', 'idle').inc()
+
+        idle.release()
+        wake.set()
@@ -0,0 +1,86 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# ccache.py - Content-addressed cache of finished conversions. Lets the workers
+# skip ffmpeg entirely when the same input is converted with the same settings.
+
+
+from datetime import datetime, timezone
+from typing import Optional
+
+from bson import ObjectId
+
+from ncconv.steps import Steps
+
+
+def cache_key(input_hash: str, scale_pitch: float, scale_tempo: float, output_format: str) -> str:
+    '''
+    Builds the cache key for a conversion.
+
+    :param input_hash: Hex digest of the uploaded file
+    :param scale_pitch: pitch scale factor
+    :param scale_tempo: tempo scale factor
+    :param output_format: One of m4a or ogg
+    '''
+    return f'{input_hash}:{scale_pitch!r}:{scale_tempo!r}:{output_format}'
+
+
+def cache_lookup(db, key: str, expire_time: datetime) -> Steps[Optional[ObjectId]]:
+    '''
+    Returns the id of a live artifact produced by an earlier conversion with the same key, or None.
+
+    On a hit, the artifact (and the cache entry) are kept alive until at least expire_time,
+    so the artifact cannot expire from under the task that is about to reference it. A step generator (see steps.py).
+
+    :param db: Database reference
+    :param key: Key from cache_key
+    :param expire_time: Time until which the artifact must remain available
+    '''
+    entry = yield db.convcache.find_one({'_id': key})
+
+    if entry:
+        # the TTL monitor only runs once a minute, so make sure the artifact has not expired already
+        fi = yield db.music.files.find_one_and_update(
+            {'_id': entry['file_id'], 'metadata.expire_time': {'$gt': datetime.now(timezone.utc)}},
+            {'$max': {'metadata.expire_time': expire_time}},
+            projection={'_id': 1}
+        )
+
+        if fi:
+            yield db.convcache.update_one({'_id': key}, {'$max': {'expire_time': expire_time}})
+            yield db.stats.update_one({'_id': 'conversion_cache'}, {'$inc': {
+                'hits': 1,
+                'seconds_saved': entry.get('encode_seconds', 0)
+            }}, upsert=True)
+
+            return fi['_id']
+
+        # The artifact is gone, so is the entry
+        yield db.convcache.delete_one({'_id': key, 'file_id': entry['file_id']})
+
+    yield db.stats.update_one({'_id': 'conversion_cache'}, {'$inc': {'misses': 1}}, upsert=True)
+
+    return None
+
+
+def cache_store(db, key: str, file_id: ObjectId, expire_time: datetime, encode_seconds: float) -> Steps[None]:
+    '''
+    Records a finished conversion so that later jobs with the same key can reuse it. A step generator.
+
+    :param db: Database reference
+    :param key: Key from cache_key
+    :param file_id: The artifact produced by the conversion
+    :param expire_time: When the artifact expires. The entry expires with it.
+    :param encode_seconds: How long the conversion took, used to report how much time hits save
+    '''
+    yield db.convcache.replace_one({'_id': key}, {
+        '_id': key,
+        'file_id': file_id,
+        'expire_time': expire_time,
+        'encode_seconds': encode_seconds
+    }, upsert=True)
@@ -40,11 +40,55 @@ BIND_HTTP_PORT = config('HTTP_PORT', cast=int, default=8080)
 HTTP_WORKERS = config('HTTP_WORKERS', cast=int, default=cpu_count())
 # How many threads to spawn for converting files
 FFMPEG_WORKERS = config('FFMPEG_WORKERS', cast=int, default=cpu_count())
+# How many threads the ffmpeg processes may use between them
+FFMPEG_THREADS = config('FFMPEG_THREADS', cast=int, default=cpu_count())
+# How many threads to spawn for converting previews, which don't wait behind full conversions
+PREVIEW_WORKERS = config('PREVIEW_WORKERS', cast=int, default=1)
+# How much of a file a preview converts, in seconds of output
+PREVIEW_SECONDS = config('PREVIEW_SECONDS', cast=float, default=15)
+# How the workers run: threads (one per conversion, blocking) or asyncio (one event loop, ffmpeg's filters only)
+WORKER_ENGINE = config('WORKER_ENGINE', default='threads')
+# How long a worker may go without checking in before its job is given to another worker, in seconds
+LEASE_DURATION = config('LEASE_DURATION', cast=float, default=60)
+# How many times a job is tried before it is failed, in case it is what keeps killing the workers
+MAX_ATTEMPTS = config('MAX_ATTEMPTS', cast=int, default=3)
+# What applies the nightcore effect: ffmpeg (its filters) or numpy (in-process, needs numpy and scipy)
+DSP_ENGINE = config('DSP_ENGINE', default='ffmpeg')
+# Whether ncconv.main converts files itself, or leaves that to ncconv.worker processes
+EMBEDDED_WORKERS = config('EMBEDDED_WORKERS', cast=bool, default=True)
+# How many seconds a job is pushed back in the queue per second of audio, so that short jobs go first
+SJF_WEIGHT = config('SJF_WEIGHT', cast=float, default=0.1)
+# How many seconds each job pushes back the next job of the same client, on top of SJF_WEIGHT, so that one client can't hold everyone else up
+FAIR_JOB_COST = config('FAIR_JOB_COST', cast=float, default=10)
+# Refuse conversions that would wait for longer than this many seconds for a worker, before storing their upload. 0 accepts any
+ADMISSION_MAX_WAIT = config('ADMISSION_MAX_WAIT', cast=float, default=600)
+# How often to look for new jobs when change streams are unavailable (standalone mongod), in seconds
+QUEUE_POLL_INTERVAL = config('QUEUE_POLL_INTERVAL', cast=float, default=1)
+# How old the queue snapshot used to report positions in line may get, in seconds
+QUEUE_SNAPSHOT_INTERVAL = config('QUEUE_SNAPSHOT_INTERVAL', cast=float, default=2)
+# How often /convert/events looks for changes to a task, in seconds
+TASK_EVENTS_INTERVAL = config('TASK_EVENTS_INTERVAL', cast=float, default=1)
+# Where rate limits are kept: mongo (exact, one query per request) or local (in memory, synced every RATELIMIT_SYNC_INTERVAL seconds)
+RATELIMIT_BACKEND = config('RATELIMIT_BACKEND', default='mongo')
+RATELIMIT_SYNC_INTERVAL = config('RATELIMIT_SYNC_INTERVAL', cast=float, default=1)
+# How many converted files' metadata each HTTP worker keeps in memory
+ARTIFACT_CACHE_SIZE = config('ARTIFACT_CACHE_SIZE', cast=int, default=1024)
+# Where to keep copies of converted files, so that they are sent from disk instead of GridFS. None keeps none
+ARTIFACT_DISK_DIR = config('ARTIFACT_DISK_DIR', default=None)
+# How many bytes of copies that directory may hold before the least recently downloaded ones are deleted
+ARTIFACT_DISK_SIZE = config('ARTIFACT_DISK_SIZE', cast=int, default=(1024 ** 3))
+# Where the processes keep their metrics, so that /api/metrics adds them all up. Needed if HTTP_WORKERS is more than 1
+METRICS_DIR = config('METRICS_DIR', default=None)
 # If using sentry, specify DSN here
 SENTRY_DSN = config('SENTRY_DSN', default=None)
 # refuse to store files larger than this
 MAX_ARTIFACT_SIZE = config(
     'MAX_ARTIFACT_SIZE', cast=int, default=(20 * (1024 ** 2)))
+# refuse uploads larger than this
+MAX_UPLOAD_SIZE = config(
+    'MAX_UPLOAD_SIZE', cast=int, default=(20 * (1024 ** 2)))
+# how much of an upload ffprobe gets to see
+PROBE_SIZE = config('PROBE_SIZE', cast=int, default=(5 * (1024 ** 2)))
 
 # Not a configuration option, but it lives here because I said so :)
 VERSION = '0.1-ALPHA'
@@ -10,130 +10,282 @@
 
 
 from contextlib import suppress
-from datetime import datetime, timedelta, timezone
-from os import path
-from queue import Empty, Queue
-import re
-from threading import Thread
+from datetime import datetime
+from queue import Empty, Queue, SimpleQueue
+from threading import Event, Semaphore, Thread
+from time import monotonic
+from typing import Callable, Tuple
 from fastapi import HTTPException
 
 from pymongo import MongoClient
 import gridfs
 import sentry_sdk
 
-from ncconv.config import FFMPEG_WORKERS, SENTRY_DSN
-from ncconv.ffconv import convert_audio
+from ncconv.admission import announce_workers
+from ncconv.config import FFMPEG_THREADS, FFMPEG_WORKERS, LEASE_DURATION, PREVIEW_SECONDS, PREVIEW_WORKERS, SENTRY_DSN
+from ncconv.diskstore import disk_store
+from ncconv.ffconv import convert_audio, convert_audio_outputs
+from ncconv.jobs import (PREVIEW_HEARTBEAT, CpuBudget, Job, PreviewJob, claim_next, extend_lease, fail_stuck_jobs, job_claim,
+                         lease_owner, preview_claim, progress_reporter, watch_queue)
+from ncconv.metrics import WORKERS
+from ncconv.steps import run_steps
 
 
-def fftask(q: Queue, db: MongoClient):
+def fftask(q: SimpleQueue, db: MongoClient, workers: int = FFMPEG_WORKERS, threads: int = FFMPEG_THREADS,
+           preview_workers: int = PREVIEW_WORKERS):
     '''
-    This thread spawns FFMPEG_WORKER threads to handle conversion jobs.
-    Once threads are spawned, it waits for incoming requests and dispatches them to workers as needed.
+    This thread spawns worker threads to handle conversion jobs.
+    Once threads are spawned, it waits for jobs to be enqueued and claims as many as there are idle workers to take them.
 
-    Sending any value but None on q will cause the thread to terminate child threads and die
+    Previews are claimed by workers of their own, so that they never wait behind full conversions.
+
+    Sending any value but None on q will cause the thread to stop claiming jobs, wait for the jobs in progress
+    to finish, and die
 
     :param q: Termination signal queue
+    :param db: Database reference
+    :param workers: How many conversions to run at the same time
+    :param threads: How many threads the conversions may use between them
+    :param preview_workers: How many previews to convert at the same time, each with a thread of its own
     '''
     wq = Queue()
+    pq = Queue()
+    # One permit per idle worker. Taken when a job is claimed and given back when the job is done,
+    # so wq never holds more jobs than there are workers free to take them.
+    idle = Semaphore(workers)
+    preview_idle = Semaphore(preview_workers)
+    # Set when there may be something to do: a job was enqueued or a worker became idle
+    wake = Event()
+    stop = Event()
+    budget = CpuBudget(threads)
 
     my_threads = [Thread(target=_ffworker, args=(
-        wq, db), name=f'fftask-{i+1}') for i in range(FFMPEG_WORKERS)]
+        wq, db, idle, wake, budget), name=f'fftask-{i+1}') for i in range(workers)]
+    my_threads += [Thread(target=_preview_worker, args=(
+        pq, db, preview_idle, wake), name=f'fftask-preview-{i+1}') for i in range(preview_workers)]
+    my_threads.append(Thread(target=watch_queue, args=(
+        db, wake, stop), name='fftask-watch'))
+
+    WORKERS.labels('convert', 'idle').inc(workers)
+    WORKERS.labels('preview', 'idle').inc(preview_workers)
 
     for t in my_threads:
         t.start()
 
+    # Nothing announces that a lease has expired, so look for those every now and then
+    reclaimed = None
+    announced = None
+
     while True:
         try:
             with suppress(Empty):
-                poison = q.get(block=True, timeout=1)
+                poison = q.get_nowait()
                 if poison:
                     break
 
-            # this is an atomic operation with respect to the doc
-            doc = db.queue.find_one_and_update(
-                {'state': 0},
-                {'$inc': {'state': 1}},
-                sort=[('_id', 1)]
-            )
+            woken = wake.wait(timeout=1)
+            due = reclaimed is None or monotonic() - reclaimed >= LEASE_DURATION / 2
+
+            # the timeout is only there to look at q and the leases now and then
+            if not woken and not due:
+                continue
+
+            wake.clear()
+
+            if due:
+                reclaimed = monotonic()
+                run_steps(fail_stuck_jobs(db))
+
+            # so that the HTTP server can tell how long new jobs would wait
+            if announced is None or monotonic() - announced >= LEASE_DURATION / 3:
+                announced = monotonic()
+                run_steps(announce_workers(db, lease_owner, workers, preview_workers))
 
-            if doc:
-                wq.put(doc, block=True)
+            # Previews first, somebody is listening for them right now
+            _claim(db, preview_idle, pq, preview_claim)
+            _claim(db, idle, wq, job_claim)
         except Exception as e:
             if SENTRY_DSN:
                 sentry_sdk.capture_exception(e)
 
             print(e)
 
-    for t in range(FFMPEG_WORKERS):
+            # try again in a bit
+            wake.set()
+            stop.wait(1)
+
+    stop.set()
+
+    for t in range(workers):
         wq.put(1, block=True)
 
+    for t in range(preview_workers):
+        pq.put(1, block=True)
+
     for t in my_threads:
         t.join()
 
+    WORKERS.labels('convert', 'idle').dec(workers)
+    WORKERS.labels('preview', 'idle').dec(preview_workers)
+
+
+def _claim(db, idle: Semaphore, jobs: Queue, claim: Callable[[datetime], Tuple[dict, dict]]):
+    '''
+    Claims jobs for as long as there are idle workers to take them and jobs to be claimed.
+
+    :param db: Database reference
+    :param idle: One permit per idle worker
+    :param jobs: Where the workers take their jobs from
+    :param claim: preview_claim or job_claim
+    '''
+    while idle.acquire(blocking=False):
+        try:
+            doc = run_steps(claim_next(db, claim))
+        except BaseException:
+            idle.release()
+            raise
+
+        if not doc:
+            idle.release()
+            break
+
+        jobs.put(doc, block=True)
+
+
+class _Heartbeat(Thread):
+    '''
+    Keeps extending the lease on a job until stopped, so that other workers don't take it over while it is converted.
 
-def _ffworker(q: Queue, db):
+    :param interval: How often to extend it, in seconds
+    :param lost: Called if the lease is lost
+    '''
+
+    def __init__(self, db, lease: dict, interval: float = LEASE_DURATION / 3, lost: Callable[[], None] = lambda: None):
+        super().__init__(daemon=True)
+        self.db, self.lease, self.interval, self.lost, self.stopped = db, lease, interval, lost, Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not run_steps(extend_lease(self.db, self.lease)):
+                self.lost()
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _ffworker(q: Queue, db, idle: Semaphore, wake: Event, budget: CpuBudget):
     '''
     FFmpeg worker thread. Spawned by fftask. Listens on q for jobs, performs the job, and updates the db record with the result
 
     :param q: Job queue
     :param db: Database reference
+    :param idle: Released whenever a job is done
+    :param wake: Set whenever a job is done, so that fftask claims the next one
+    :param budget: Decides how many threads each conversion gets
     '''
 
-    g = gridfs.GridFS(db, collection='music')
+    bucket = gridfs.GridFSBucket(db, bucket_name='music')
+    store = disk_store()
 
     while (doc := q.get(block=True)) != 1:
+        WORKERS.labels('convert', 'idle').dec()
+        WORKERS.labels('convert', 'busy').inc()
+
+        job = Job(db, bucket, doc, store)
+        heartbeat = _Heartbeat(db, job.lease)
+        heartbeat.start()
+
         try:
             try:
-                pending_file, scale_pitch, scale_tempo, output_format = doc[
-                    'pending_file'], doc['scale_pitch'], doc['scale_tempo'], doc['output_format']
-                f = g.find_one(pending_file)
-
-                if not f:
-                    raise HTTPException(
-                        status_code=404, detail='No such pending file')
-
-                # rename and escape the filename
-                fn = re.sub(r'(?u)[^-\w.]', '',
-                            f.filename.strip().replace(' ', '_'))
-                fn = path.splitext(fn)[0] + '.night' + \
-                    ('.m4a' if output_format == 'm4a' else '.ogg')
-
-                # Perform the conversion and upload it
-                buf = convert_audio(f.read(), output_format,
-                                    scale_tempo, scale_pitch)
-                inserted_id = g.put(buf, metadata={
-                    'content_type': 'audio/mp4' if output_format == 'm4a' else 'audio/ogg',
-                    'expire_time': datetime.now(timezone.utc) + timedelta(days=1),
-                    'uploaded_by': str(doc['enqueued_by'])
-                }, filename=fn)
-
-                # update the database document so that a client calling /check can see the new file
-                db.queue.replace_one({'_id': doc['_id']}, {
-                    '_id': doc['_id'],
-                    'state': 2,
-                    'completed_file': inserted_id,
-                    'expire_time': doc['expire_time']
-
-                })
+                seconds = 0
+
+                if (f := run_steps(job.start())):
+                    started = monotonic()
+                    threads = budget.take()
+
+                    try:
+                        # the probe normally happened at upload time
+                        convert_audio_outputs(f, job.writers, doc['scale_tempo'], doc['scale_pitch'], doc.get('input_format'),
+                                              doc.get('sample_rate'), threads, doc.get('duration'), progress_reporter(db, doc['_id']))
+                    except BaseException:
+                        # don't leave the chunks uploaded so far behind
+                        run_steps(job.abort())
+                        raise
+                    finally:
+                        budget.give_back(threads)
+
+                    seconds = monotonic() - started
+
+                run_steps(job.finish(seconds))
             except (HTTPException, Exception) as e:
-                if isinstance(e, HTTPException):
-                    status_code, detail = e.status_code, e.detail
-                else:
-                    status_code, detail = 500, "An unexpected error occurred during the conversion of your file. Try again!"
-
-                db.queue.replace_one({'_id': doc['_id']}, {
-                    'state': 3,
-                    'status_code': status_code,
-                    'detail': detail,
-                    'expire_time': doc['expire_time']
-                })
+                run_steps(job.fail(e))
+                raise e
+            finally:
+                heartbeat.stop()
+                run_steps(job.close())
+        except Exception as e:
+            if SENTRY_DSN:
+                sentry_sdk.capture_exception(e)
+
+            print(e)
+        finally:
+            WORKERS.labels('convert', 'busy').dec()
+            WORKERS.labels('convert', 'idle').inc()
+
+            idle.release()
+            wake.set()
+
+
+def _preview_worker(q: Queue, db, idle: Semaphore, wake: Event):
+    '''
+    Preview worker thread. Spawned by fftask. Converts the start of a file into the GridFS file that the client is
+    reading it from, and marks the job as done or failed. Previews hold a lease like conversions do, but are never
+    retried, and stop when they are cancelled.
+
+    :param q: Job queue
+    :param db: Database reference
+    :param idle: Released whenever a job is done
+    :param wake: Set whenever a job is done, so that fftask claims the next one
+    '''
+
+    bucket = gridfs.GridFSBucket(db, bucket_name='music')
+
+    while (doc := q.get(block=True)) != 1:
+        WORKERS.labels('preview', 'idle').dec()
+        WORKERS.labels('preview', 'busy').inc()
 
+        job = PreviewJob(db, bucket, doc)
+        heartbeat = _Heartbeat(db, job.lease, PREVIEW_HEARTBEAT, job.lost)
+        heartbeat.start()
+
+        try:
+            try:
+                f, writer = run_steps(job.start())
+
+                try:
+                    convert_audio(f, writer, doc['output_format'], doc['scale_tempo'], doc['scale_pitch'],
+                                  doc['input_format'], doc['sample_rate'], 1, preview=PREVIEW_SECONDS)
+                except BaseException:
+                    run_steps(job.abort())
+                    raise
+
+                run_steps(job.finish())
+            except (HTTPException, Exception) as e:
+                run_steps(job.fail(e))
                 raise e
             finally:
-                with suppress(Exception):
-                    g.delete(pending_file)
+                heartbeat.stop()
+                run_steps(job.close())
         except Exception as e:
             if SENTRY_DSN:
                 sentry_sdk.capture_exception(e)
 
             print(e)
+        finally:
+            WORKERS.labels('preview', 'busy').dec()
+            WORKERS.labels('preview', 'idle').inc()
+
+            idle.release()
+            wake.set()
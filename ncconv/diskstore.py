@@ -0,0 +1,261 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# diskstore.py - Keeps copies of converted files on the local filesystem, so that
+# downloads don't have to be read out of GridFS. GridFS stays the source of truth.
+
+
+import asyncio
+from contextlib import suppress
+import os
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Optional
+
+from bson import ObjectId
+from starlette.concurrency import run_in_threadpool
+import sentry_sdk
+
+from ncconv.config import ARTIFACT_DISK_DIR, ARTIFACT_DISK_SIZE, SENTRY_DSN
+from ncconv.metrics import DISK_READS
+
+
+# Copies that are being written start with this, and are renamed once they are complete
+_TEMP_PREFIX = '.tmp-'
+# Copies that were never finished, because their process died, are deleted after this many seconds
+_TEMP_GRACE = 3600
+
+
+def _report(e: Exception):
+    # The copies are only there to save work, GridFS is read instead when they fail
+    if SENTRY_DSN:
+        sentry_sdk.capture_exception(e)
+
+    print(e)
+
+
+class DiskWriter:
+    '''
+    A copy that is being written. Failing to write it never fails whatever is writing, the copy is just dropped.
+    '''
+
+    def __init__(self, store: 'DiskStore'):
+        self.store = store
+        self.file = None
+        self.written = 0
+
+        try:
+            self.file = NamedTemporaryFile(dir=store.directory, prefix=_TEMP_PREFIX, delete=False)
+        except OSError as e:
+            self._failed(e)
+
+    def write(self, buf: bytes):
+        if not self.file:
+            return
+
+        try:
+            self.file.write(buf)
+            self.written += len(buf)
+        except OSError as e:
+            self._failed(e)
+
+    def commit(self, file_id: ObjectId):
+        '''
+        Makes the copy available as file_id.
+        '''
+        if not self.file:
+            return
+
+        try:
+            self.file.close()
+            # atomic, so that nobody ever reads half a copy
+            os.replace(self.file.name, self.store.path(file_id))
+            self.file = None
+        except OSError as e:
+            self._failed(e)
+            return
+
+        self.store.evict(self.written)
+
+    def abort(self):
+        if not self.file:
+            return
+
+        self.file.close()
+        with suppress(OSError):
+            os.remove(self.file.name)
+
+        self.file = None
+
+    def _failed(self, e: OSError):
+        _report(e)
+        self.abort()
+
+
+class DiskStore:
+    '''
+    Copies of artifacts in a directory, which may be shared by several machines. A copy is written when a worker
+    stores an artifact, or when one that has no copy is downloaded. Once the directory holds more than size bytes,
+    the copies that were read least recently are deleted.
+
+    When each copy was last read is kept in its modification time, so that every process sharing the directory
+    agrees on it. Anything that isn't here is read from GridFS instead.
+    '''
+
+    def __init__(self, directory: str, size: int):
+        self.directory, self.size = directory, size
+        os.makedirs(directory, exist_ok=True)
+
+        # bytes written since the directory was last looked at, which it may have gone over the size by
+        self.pending = 0
+        self.used = None
+        self.lock = Lock()
+        # copies that are being filled from GridFS by this process, in the background
+        self.filling: Dict[ObjectId, asyncio.Future] = {}
+
+    def path(self, file_id: ObjectId) -> str:
+        return os.path.join(self.directory, str(file_id))
+
+    def writer(self) -> DiskWriter:
+        '''
+        Returns a new copy, which is only made available by DiskWriter.commit.
+        '''
+        return DiskWriter(self)
+
+    def open(self, file_id: ObjectId) -> Optional[BinaryIO]:
+        '''
+        Opens the copy of an artifact and marks it as recently used. Returns None if there is none.
+        Once it is open, evicting it doesn't take it away from the reader.
+        '''
+        try:
+            f = open(self.path(file_id), 'rb')
+        except FileNotFoundError:
+            return None
+
+        with suppress(OSError):
+            os.utime(f.fileno())
+
+        return f
+
+    def remove(self, file_ids: Iterable[ObjectId]):
+        '''
+        Deletes the copies of artifacts that no longer exist.
+        '''
+        for file_id in file_ids:
+            with suppress(FileNotFoundError):
+                os.remove(self.path(file_id))
+
+    def evict(self, added: int = 0):
+        '''
+        Deletes the least recently used copies until the directory fits into the size again.
+
+        :param added: How many bytes were just added to the directory
+        '''
+        with self.lock:
+            self.pending += added
+
+            # Other processes write to the directory as well, so it is only looked at when it may be full
+            if self.used is not None and self.used + self.pending <= self.size:
+                return
+
+            now = time()
+            copies = []
+            used = 0
+
+            try:
+                with os.scandir(self.directory) as entries:
+                    for entry in entries:
+                        with suppress(OSError):
+                            st = entry.stat()
+
+                            if entry.name.startswith(_TEMP_PREFIX):
+                                if now - st.st_mtime > _TEMP_GRACE:
+                                    os.remove(entry.path)
+                                continue
+
+                            copies.append((st.st_mtime, st.st_size, entry.path))
+                            used += st.st_size
+            except OSError as e:
+                # Like writing a copy, this never fails whatever is writing. It is tried again after the next copy.
+                _report(e)
+                return
+
+            copies.sort()
+
+            for _, size, fn in copies:
+                if used <= self.size:
+                    break
+
+                with suppress(FileNotFoundError):
+                    os.remove(fn)
+                used -= size
+
+            self.used, self.pending = used, 0
+
+    async def open_or_fill(self, fi: dict, grid_out: Callable[[], Any]) -> Optional[BinaryIO]:
+        '''
+        Opens the copy of an artifact. If there is none, returns None, in which case it should be read from GridFS,
+        and starts copying it out of GridFS in the background for the downloads that come after. The request doesn't
+        wait for the copy, which would hold up a seek near the end of a large file until all of it was copied.
+
+        :param fi: files document of the artifact
+        :param grid_out: Opens the artifact in GridFS (Motor)
+        '''
+        if (f := await run_in_threadpool(self.open, fi['_id'])):
+            DISK_READS.labels('hit').inc()
+            return f
+
+        if fi['length'] > self.size:
+            DISK_READS.labels('miss').inc()
+            return None
+
+        # Only one copy of a file is made at a time
+        if fi['_id'] not in self.filling:
+            self.filling[fi['_id']] = asyncio.ensure_future(self._fill(fi, grid_out()))
+
+        DISK_READS.labels('filling').inc()
+
+        return None
+
+    async def _fill(self, fi: dict, grid_out):
+        try:
+            copy = await run_in_threadpool(self.writer)
+
+            try:
+                while (chunk := await grid_out.readchunk()):
+                    await run_in_threadpool(copy.write, chunk)
+            except BaseException:
+                # including the server shutting down
+                copy.abort()
+                raise
+
+            # The chunks may have been deleted along with the file in the meantime
+            if copy.written == fi['length']:
+                await run_in_threadpool(copy.commit, fi['_id'])
+            else:
+                await run_in_threadpool(copy.abort)
+        except Exception as e:
+            _report(e)
+        finally:
+            self.filling.pop(fi['_id'], None)
+
+
+_disk_store = None
+
+
+def disk_store() -> Optional[DiskStore]:
+    '''
+    Returns the store in ARTIFACT_DISK_DIR, or None if there is none.
+    '''
+    global _disk_store
+
+    if _disk_store is None and ARTIFACT_DISK_DIR:
+        _disk_store = DiskStore(ARTIFACT_DISK_DIR, ARTIFACT_DISK_SIZE)
+
+    return _disk_store
@@ -0,0 +1,232 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# dsp.py - Nightcore transform on raw PCM with numpy and scipy. ffmpeg only
+# decodes and encodes. Only imported if DSP_ENGINE is numpy.
+
+
+import math
+import subprocess
+from typing import BinaryIO, Callable, Dict, Optional
+
+from fastapi import HTTPException
+import numpy as np
+from scipy.signal import butter, correlate, sosfilt
+
+from ncconv.config import FFMPEG_EXEC
+from ncconv.ffconv import DspEngine, _Feeder, _StderrReader, encode_audio
+
+
+# Audio is processed as 32 bit float stereo
+_CHANNELS = 2
+_FRAME_BYTES = 4 * _CHANNELS
+
+
+class _Resampler:
+    '''
+    Plays audio back ratio times faster by reading it at fractional positions, which raises the pitch as well.
+    This is what asetrate followed by aresample does.
+    '''
+
+    def __init__(self, ratio: float):
+        self.ratio = ratio
+        # Reading faster folds everything above the new Nyquist frequency back down, so filter that out first
+        self.sos = butter(8, 0.95 / ratio, output='sos') if ratio > 1 else None
+        self.zi = np.zeros((self.sos.shape[0], 2, _CHANNELS),
+                           dtype=np.float32) if self.sos is not None else None
+        # samples that the next position may still need, and where it lies in them
+        self.tail = np.zeros((0, _CHANNELS), dtype=np.float32)
+        self.pos = 0.0
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        if self.sos is not None:
+            x, self.zi = sosfilt(self.sos, x, axis=0, zi=self.zi)
+
+        x = np.concatenate((self.tail, x.astype(np.float32, copy=False)))
+        # every position that has a sample on both sides of it
+        n = max(0, math.ceil((len(x) - 1 - self.pos) / self.ratio))
+        t = self.pos + np.arange(n) * self.ratio
+        i = t.astype(np.int64)
+        f = (t - i).astype(np.float32)[:, None]
+        y = x[i] * (1 - f) + x[i + 1] * f
+
+        end = self.pos + n * self.ratio
+        keep = min(int(end), len(x))
+        self.tail, self.pos = x[keep:], end - keep
+
+        return y
+
+    def flush(self) -> np.ndarray:
+        # the last sample has nothing after it to interpolate with
+        return self.process(np.zeros((1, _CHANNELS), dtype=np.float32))
+
+
+class _Stretcher:
+    '''
+    Changes the tempo without changing the pitch (WSOLA, like atempo). Windowed frames are taken from the input tempo
+    times further apart than they are put down in the output. Each frame is moved by up to a quarter of a hop so
+    that it lines up with the one before it, otherwise tones would cancel out where frames overlap.
+
+    Where the frames go is worked out one after another, but they are then cut out and added up all at once.
+    '''
+
+    def __init__(self, tempo: float, frame: int):
+        self.frame = frame
+        # frames overlap by three quarters in the output, so each output sample is the sum of 4 windows
+        self.hop = frame // 4
+        self.step = self.hop * tempo
+        # how far a frame may be moved, and how much of it has to line up
+        self.tolerance = self.hop // 4
+        self.template = frame // 2
+        self.win = np.hanning(frame + 1)[:-1, None].astype(np.float32)
+        # a periodic hann window adds up to 2 at that overlap
+        self.win /= 2
+        self.buf = np.zeros((0, _CHANNELS), dtype=np.float32)
+        # where the next frame would be taken from without moving it, and where the last one was
+        self.pos = 0.0
+        self.last = None
+        # the last 3 hops of output, which the next frames still add to
+        self.acc = np.zeros((3, self.hop, _CHANNELS), dtype=np.float32)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        self.buf = np.concatenate((self.buf, x))
+        out = []
+
+        # at most 256 frames at a time, so that slowing down a lot doesn't take a lot of memory
+        while (n := min(256, max(0, math.floor((len(self.buf) - self.frame - self.tolerance - self.pos) / self.step) + 1))):
+            out.append(self._overlap_add(n))
+
+        return np.concatenate(out) if out else np.zeros((0, _CHANNELS), dtype=np.float32)
+
+    def _align(self, nominal: int) -> int:
+        '''
+        Returns where the frame meant to start at nominal fits best after the last one.
+        '''
+        if self.last is None:
+            return nominal
+
+        # what would have come next in the input after the last frame
+        natural = self.last + self.hop
+        lo = max(0, nominal - self.tolerance)
+        template = self.buf[natural:natural + self.template].mean(axis=1)
+        region = self.buf[lo:nominal + self.tolerance +
+                          self.template].mean(axis=1)
+
+        return lo + int(np.argmax(correlate(region, template, mode='valid')))
+
+    def _overlap_add(self, n: int) -> np.ndarray:
+        starts = np.empty(n, dtype=np.int64)
+        for j in range(n):
+            starts[j] = self.last = self._align(round(self.pos + j * self.step))
+
+        # (frames, quarters of a frame, samples, channels)
+        frames = (self.buf[starts[:, None] + np.arange(self.frame)] * self.win).reshape(
+            n, 4, self.hop, _CHANNELS)
+
+        out = np.zeros((n + 3, self.hop, _CHANNELS), dtype=np.float32)
+        out[:3] += self.acc
+        for q in range(4):
+            out[q:q + n] += frames[:, q]
+
+        self.acc = out[n:]
+        end = self.pos + n * self.step
+        # keep what the next frame may still be taken from
+        drop = max(0, min(int(end) - self.tolerance, self.last + self.hop))
+        self.buf, self.pos, self.last = self.buf[drop:], end - drop, self.last - drop
+
+        return out[:n].reshape(-1, _CHANNELS)
+
+    def flush(self) -> np.ndarray:
+        # pad the rest of the input out to whole frames, then hand out what is left in the accumulator
+        pad = self.frame + math.ceil(self.step) + self.tolerance
+        out = self.process(np.zeros((pad, _CHANNELS), dtype=np.float32))
+        rest = self.acc.reshape(-1, _CHANNELS)
+
+        return np.concatenate((out, rest))
+
+
+class _NightcoreReader:
+    '''
+    File-like object that reads PCM from a decoder and returns it with the nightcore transform applied.
+    '''
+
+    def __init__(self, src: BinaryIO, tempo_scaler: float, pitch_scaler: float, frame: int, block: int):
+        self.src, self.block = src, block * _FRAME_BYTES
+        self.resampler = _Resampler(pitch_scaler)
+        self.stretcher = _Stretcher(tempo_scaler, frame)
+        self.pending = bytearray()
+        self.eof = False
+
+    def read(self, size: int) -> bytes:
+        while len(self.pending) < size and not self.eof:
+            raw = self.src.read(self.block)
+
+            if not raw:
+                self.eof = True
+                y = self.stretcher.process(self.resampler.flush())
+                y = np.concatenate((y, self.stretcher.flush()))
+            else:
+                # a partial frame can only happen at the very end
+                raw = raw[:len(raw) - len(raw) % _FRAME_BYTES]
+                x = np.frombuffer(raw, dtype=np.float32).reshape(-1, _CHANNELS)
+                y = self.stretcher.process(self.resampler.process(x))
+
+            self.pending += np.clip(y, -1, 1).astype(np.float32).tobytes()
+
+        out = bytes(self.pending[:size])
+        del self.pending[:size]
+
+        return out
+
+
+class NumpyEngine(DspEngine):
+    '''
+    Decodes to raw PCM with ffmpeg, applies the nightcore transform with numpy and scipy, and encodes with ffmpeg.
+
+    Unlike ffmpeg's atempo, large tempo changes take a single pass.
+
+    :param frame: Length of the frames used to change the tempo, in samples. Longer frames smear transients,
+    shorter ones make low notes warble.
+    :param block: How many samples are processed at a time
+    '''
+
+    def __init__(self, frame: int = 2048, block: int = 65536):
+        self.frame, self.block = frame, block
+
+    def convert(self, input_stream: BinaryIO, output_streams: Dict[str, BinaryIO], tempo_scaler: float, pitch_scaler: float,
+                input_format: str, orig_sample_rate: int, threads: int, report: Optional[Callable[[float], None]],
+                preview: Optional[float] = None):
+        with subprocess.Popen((FFMPEG_EXEC, '-v', 'error', '-nostats', '-threads', str(threads),
+                               '-f', input_format, '-i', 'pipe:', '-vn', '-ac', str(_CHANNELS),
+                               '-f', 'f32le', 'pipe:1'),
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as decoder:
+            feeder = _Feeder(input_stream, decoder.stdin)
+            feeder.start()
+            stderr = _StderrReader(decoder.stderr, None)
+            stderr.start()
+
+            try:
+                # The transform runs in the thread that feeds the encoder
+                encode_audio(('-f', 'f32le', '-ar', str(orig_sample_rate), '-ac', str(_CHANNELS), '-i', 'pipe:'), 'anull',
+                             _NightcoreReader(decoder.stdout, tempo_scaler, pitch_scaler, self.frame, self.block),
+                             output_streams, threads, report, preview)
+            finally:
+                # if encoding failed, nobody is reading the decoder's output anymore
+                decoder.kill()
+                decoder.wait()
+                feeder.join()
+                stderr.join()
+
+        if feeder.error:
+            raise feeder.error
+
+        # killed by us above is fine, as the encoder must have finished by then
+        if decoder.returncode > 0:
+            print(b''.join(stderr.errors))
+            raise HTTPException(
+                status_code=500, detail='Audio conversion failed')
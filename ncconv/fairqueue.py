@@ -0,0 +1,79 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# fairqueue.py - Decides where a job goes in the queue, so that short jobs go
+# first and clients that enqueue a lot at once don't hold everyone else up.
+
+
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ncconv.config import FAIR_JOB_COST, SJF_WEIGHT
+
+
+def job_cost(duration: float, output_formats: int) -> float:
+    '''
+    How far a job pushes back the next job of the same client, in seconds. Roughly proportional to the time
+    it takes to convert: a fixed part for starting it up, and a part per second of audio and output format.
+
+    :param duration: Length of the input in seconds
+    :param output_formats: How many formats it is converted to
+    '''
+    return FAIR_JOB_COST + duration * SJF_WEIGHT * output_formats
+
+
+async def sched_time(db, client: str, now: datetime, duration: float, output_formats: int) -> datetime:
+    '''
+    Lines a new job up behind the jobs its client enqueued before, and returns its sched_time, which is the order in
+    which the workers claim jobs.
+
+    This is weighted fair queueing. Each client's jobs are lined up one after another, each starting where the
+    one before it ends, or now if that is in the past. A burst of jobs from one client is spread out into the future
+    by what its jobs cost, so the jobs of other clients are interleaved with it rather than waiting behind all of it.
+    A client that waits for each job to be done before enqueueing the next is pushed back by no more than what the
+    last one cost, and short jobs still go before long ones enqueued at the same time.
+
+    Where each client's line ends is kept in the fairqueue collection and moved along in a single update, so that
+    jobs that are enqueued at the same time are lined up one after another too.
+
+    :param db: Database reference (Motor)
+    :param client: Who enqueues the job, as in enqueued_by
+    :param now: When the job is enqueued
+    :param duration: Length of the input in seconds
+    :param output_formats: How many formats it is converted to
+    '''
+    pipeline = [{'$set': {
+        # $max ignores a missing end, and adding a number to a date adds milliseconds
+        'finish': {'$add': [{'$max': ['$finish', now]}, job_cost(duration, output_formats) * 1000]}
+    }}]
+
+    try:
+        doc = await db.fairqueue.find_one_and_update({'_id': client}, pipeline, upsert=True,
+                                                     return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        # someone else created the document at the same time, try again now that it exists
+        doc = await db.fairqueue.find_one_and_update({'_id': client}, pipeline,
+                                                     return_document=ReturnDocument.AFTER)
+
+    # Motor does not restore the timezone attributes for datetime objects
+    return doc['finish'].replace(tzinfo=timezone.utc)
+
+
+async def peek_sched_time(db, client: str, now: datetime, duration: float, output_formats: int) -> datetime:
+    '''
+    Same as sched_time, but only tells where the job would go without lining it up.
+    '''
+    doc = await db.fairqueue.find_one({'_id': client})
+    start = now
+
+    if doc:
+        start = max(now, doc['finish'].replace(tzinfo=timezone.utc))
+
+    return start + timedelta(seconds=job_cost(duration, output_formats))
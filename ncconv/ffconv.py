@@ -9,27 +9,167 @@
 # ffconv.py - Functions that handle interaction with ffmpeg / ffprobe.
 
 
-import subprocess
-from typing import Tuple
-from tempfile import TemporaryDirectory
+import asyncio
+from collections import deque
+from contextlib import suppress
 import os
+import subprocess
+from threading import Thread
+from typing import Any, BinaryIO, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from fastapi import HTTPException
 from orjson import loads as json_loads
 
-from ncconv.config import FFMPEG_EXEC, FFPROBE_EXEC, DEFAULT_PITCH, DEFAULT_TEMPO, MAX_ARTIFACT_SIZE
+from ncconv.config import FFMPEG_EXEC, FFPROBE_EXEC, DEFAULT_PITCH, DEFAULT_TEMPO, DSP_ENGINE, MAX_ARTIFACT_SIZE, PROBE_SIZE
+from ncconv.metrics import PROBE_TIME
+
+
+# How much is moved between GridFS and ffmpeg at a time
+_PIPE_CHUNK = 255 * 1024
+
+
+class _Feeder(Thread):
+    '''
+    Copies a file-like object into the stdin of a child process, so that its output can be read at the same time.
+    '''
+
+    def __init__(self, src: BinaryIO, dst: BinaryIO):
+        super().__init__(daemon=True)
+        self.src, self.dst, self.error = src, dst, None
+
+    def run(self):
+        try:
+            while (buf := self.src.read(_PIPE_CHUNK)):
+                self.dst.write(buf)
+        except BrokenPipeError:
+            pass  # the child stopped reading, ffmpeg does this if it fails
+        except Exception as e:
+            self.error = e
+        finally:
+            with suppress(OSError):
+                self.dst.close()
 
 
-def _probe_audio(input_stream: bytes) -> Tuple[str, int]:
+class ProbeResult(NamedTuple):
     '''
-    Guess the input format and sample rate based on the buffer. Raise an exception if we don't know!
+    What ffprobe had to say about an input file.
+    '''
+    format: str
+    sample_rate: int
+    # seconds, only if the headers say so
+    duration: Optional[float]
+    # bits per second
+    bit_rate: Optional[int]
+
+    def estimate_duration(self, size: int) -> float:
+        '''
+        Estimates the length of the file in seconds. ffprobe can only see the start of the file,
+        so this falls back to the bit rate (or a typical 128 kb/s) and the size of the whole file.
+
+        :param size: Size of the whole file in bytes
+        '''
+        if self.duration:
+            return self.duration
+
+        return size * 8 / (self.bit_rate or 128000)
+
+
+class _StderrReader(Thread):
+    '''
+    Drains ffmpeg's stderr, which carries both the reports requested with -progress and any error messages.
+    Calls progress_cb with the position in the output in seconds whenever ffmpeg reports it.
+    '''
+
+    def __init__(self, src: BinaryIO, progress_cb: Optional[Callable[[float], None]]):
+        super().__init__(daemon=True)
+        self.src, self.progress_cb = src, progress_cb
+        # the last few lines that weren't progress reports, for when ffmpeg fails
+        self.errors = deque(maxlen=20)
+
+    def run(self):
+        for line in self.src:
+            _stderr_line(line, self.errors, self.progress_cb)
+
+
+def _stderr_line(line: bytes, errors: deque, progress_cb: Optional[Callable[[float], None]]):
+    '''
+    Handles a line that ffmpeg wrote to stderr, see _StderrReader.
+    '''
+    key, eq, value = line.strip().partition(b'=')
+
+    # progress reports are key=value lines, one per line
+    if not eq or b' ' in key:
+        errors.append(line)
+    elif key == b'out_time_us' and progress_cb:
+        try:
+            progress_cb(int(value) / 1e6)
+        except ValueError:
+            pass  # N/A before the first packet
+        except Exception as e:
+            print(e)
+
+
+# ffprobe only gets to see the first PROBE_SIZE bytes of a file, so don't let it wait for more
+__ffprobe_args = (FFPROBE_EXEC, '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams',
+                  '-probesize', str(PROBE_SIZE), '-')
+
+
+def _probe_audio(input_stream: BinaryIO) -> ProbeResult:
+    '''
+    Guess the input format and sample rate based on the start of the stream. Raise an exception if we don't know!
 
     :param input_stream: Audio stream to guess the type of
     '''
 
-    proc = subprocess.run((FFPROBE_EXEC, '-v', 'quiet', '-print_format', 'json',
-                          '-show_format', '-show_streams', '-'), capture_output=True, input=input_stream)
-    format_info = json_loads(proc.stdout)
+    prefix = input_stream.read(PROBE_SIZE)
+
+    with PROBE_TIME.time():
+        proc = subprocess.run(__ffprobe_args, capture_output=True,
+                              input=prefix)
+
+    return _parse_probe(proc.stdout)
+
+
+async def probe_audio(prefix: bytes) -> ProbeResult:
+    '''
+    Same as _probe_audio, but doesn't block the event loop. Used to check uploads while they are being stored.
+
+    :param prefix: At most the first PROBE_SIZE bytes of the audio file
+    '''
+
+    with PROBE_TIME.time():
+        proc = await asyncio.create_subprocess_exec(*__ffprobe_args, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            out, _ = await proc.communicate(prefix)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+
+    return _parse_probe(out)
+
+
+def sniff_audio(head: bytes) -> bool:
+    '''
+    Checks the start of a file against the signatures of the formats that ffprobe may report, so that uploads that
+    can't be audio are refused before they are stored. ffprobe still has the final say.
+
+    :param head: At least the first 12 bytes of the file, unless it is shorter
+    '''
+    return (head.startswith((b'OggS', b'fLaC', b'ID3'))
+            or (head[:4] in (b'RIFF', b'RF64') and head[8:12] == b'WAVE')
+            # an MPEG audio frame without tags in front of it
+            or (len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0))
+
+
+def _parse_probe(out: bytes) -> ProbeResult:
+    '''
+    Pulls the input format, sample rate and length out of ffprobe's output.
+
+    :param out: What ffprobe wrote to stdout
+    '''
+
+    format_info = json_loads(out or b'{}')
 
     if 'format' not in format_info or 'streams' not in format_info or format_info['format']['format_name'] not in ('ogg', 'oga', 'opus', 'mp3', 'flac', 'wav'):
         print(format_info)
@@ -47,7 +187,21 @@ def _probe_audio(input_stream: bytes) -> Tuple[str, int]:
         raise HTTPException(
             status_code=400, detail='Could not find stream in input file')
 
-    return format, sample_rate
+    # Used to schedule short jobs first. Not every format has these in its headers.
+    duration = _number(stream.get('duration', format_info['format'].get('duration')))
+    bit_rate = _number(stream.get('bit_rate', format_info['format'].get('bit_rate')))
+
+    return ProbeResult(format, sample_rate, duration, int(bit_rate) if bit_rate else None)
+
+
+def _number(value) -> Optional[float]:
+    '''
+    ffprobe reports numbers as strings, and may report "N/A" for unknown ones.
+    '''
+    try:
+        return float(value) or None
+    except (TypeError, ValueError):
+        return None
 
 
 def _construct_filters(tempo_scaler: float, orig_sample_rate: int, new_sample_rate: int) -> str:
@@ -84,49 +238,393 @@ def _construct_filters(tempo_scaler: float, orig_sample_rate: int, new_sample_ra
 
 
 # converts the output_format string to the ffmpeg params
-# input -> (format, codec)
+# input -> (format, codec, muxer options)
+# The mp4 muxer normally has to seek back to the start of the output to write the index, which pipes can't do.
+# A fragmented mp4 writes an empty index up front and then one fragment per second, so it can be streamed.
 __ffmpeg_formats = {
-    'm4a': ('mp4', 'aac'),
-    'ogg': ('ogg', 'libvorbis')
+    'm4a': ('mp4', 'aac', ('-movflags', 'empty_moov+default_base_moof', '-frag_duration', '1000000')),
+    'ogg': ('ogg', 'libvorbis', ())
 }
 
+# Previews trade quality for speed. Vorbis can't go much lower at 44.1 kHz stereo.
+__preview_bitrates = {'aac': '48k', 'libvorbis': '64k'}
+
+
+class _Collector(Thread):
+    '''
+    Copies one of ffmpeg's outputs into a file-like object. Kills ffmpeg if the output grows larger than
+    MAX_ARTIFACT_SIZE, or can't be written, since nobody would be reading it anymore.
+    '''
+
+    def __init__(self, proc: subprocess.Popen, src: BinaryIO, dst: BinaryIO):
+        super().__init__(daemon=True)
+        self.proc, self.src, self.dst, self.error = proc, src, dst, None
+
+    def run(self):
+        try:
+            written = 0
+            while (buf := self.src.read(_PIPE_CHUNK)):
+                written += len(buf)
+                if written > MAX_ARTIFACT_SIZE:
+                    raise HTTPException(
+                        status_code=400, detail='Resulting file exceeded the size limit.')
+
+                self.dst.write(buf)
+        except BaseException as e:
+            self.error = e
+            self.proc.kill()
+        finally:
+            self.src.close()
 
-def convert_audio(input_stream: bytes, output_format: str = 'm4a', tempo_scaler: float = DEFAULT_TEMPO, pitch_scaler: float = DEFAULT_PITCH) -> bytes:
+
+def convert_audio(input_stream: BinaryIO, output_stream: BinaryIO, output_format: str = 'm4a', tempo_scaler: float = DEFAULT_TEMPO, pitch_scaler: float = DEFAULT_PITCH,
+                  input_format: Optional[str] = None, orig_sample_rate: Optional[int] = None, threads: int = 0,
+                  duration: Optional[float] = None, progress_cb: Optional[Callable[[float], None]] = None,
+                  preview: Optional[float] = None):
     '''
-    Perform the conversion and returns the result.
+    Perform the conversion, writing the result to output_stream as it is produced.
+
+    Neither the input nor the output is ever held in memory as a whole. If the output grows larger than
+    MAX_ARTIFACT_SIZE, the conversion is aborted with whatever was written to output_stream so far.
 
     This routine blocks and shouldn't be called on the main thread.
 
-    :param input_stream: Audio stream to convert
+    :param input_stream: Audio stream to convert. Must be seekable if it has not been probed.
+    :param output_stream: Where to write the converted audio
     :param output_format: One of m4a or ogg
     :param tempo_scaler: Percent by which to change the tempo as a fraction of 1
     :param pitch_scaler: Percent by which to change the pitch as a fraction of 1
+    :param input_format: Format of input_stream as reported by probe_audio, if known
+    :param orig_sample_rate: Sample rate of input_stream as reported by probe_audio, if known
+    :param threads: How many threads ffmpeg may use. 0 lets ffmpeg decide.
+    :param duration: Length of the input in seconds, used for progress reports
+    :param progress_cb: Called with the percentage of the input that has been converted, every half a second or so
+    :param preview: If given, only this many seconds of output are produced, at a low bitrate
+    '''
+
+    convert_audio_outputs(input_stream, {output_format: output_stream}, tempo_scaler, pitch_scaler,
+                          input_format, orig_sample_rate, threads, duration, progress_cb, preview)
+
+
+def convert_audio_outputs(input_stream: BinaryIO, output_streams: Dict[str, BinaryIO], tempo_scaler: float = DEFAULT_TEMPO, pitch_scaler: float = DEFAULT_PITCH,
+                          input_format: Optional[str] = None, orig_sample_rate: Optional[int] = None, threads: int = 0,
+                          duration: Optional[float] = None, progress_cb: Optional[Callable[[float], None]] = None,
+                          preview: Optional[float] = None):
+    '''
+    Same as convert_audio, but encodes to several formats at once. The input is decoded and filtered once,
+    and the filtered audio is split between one encoder per format.
+
+    If any of the outputs fails, the whole conversion is aborted.
+
+    :param output_streams: Maps each output format (m4a or ogg) to where to write it
+    '''
+
+    if not input_format or not orig_sample_rate:
+        input_format, orig_sample_rate, *_ = _probe_audio(input_stream)
+        input_stream.seek(0)
+
+    if any(output_format not in __ffmpeg_formats for output_format in output_streams):
+        raise HTTPException(
+            status_code=400, detail='Unsupported output format')
+
+    dsp_engine().convert(input_stream, output_streams, tempo_scaler, pitch_scaler, input_format, orig_sample_rate, threads,
+                         _reporter(tempo_scaler, pitch_scaler, duration, progress_cb), preview)
+
+
+def _reporter(tempo_scaler: float, pitch_scaler: float, duration: Optional[float],
+              progress_cb: Optional[Callable[[float], None]]) -> Optional[Callable[[float], None]]:
+    '''
+    Turns progress_cb into a callback that takes the position in the output in seconds, if there is enough to go on.
+    '''
+    if not duration or not progress_cb:
+        return None
+
+    # Both scalers speed the audio up, so the output is shorter than the input
+    def report(out_time: float):
+        progress_cb(min(100.0, out_time * tempo_scaler * pitch_scaler * 100 / duration))
+
+    return report
+
+
+class DspEngine:
+    '''
+    Interface for the code that applies the nightcore transform. Decoding and encoding is always done by ffmpeg.
     '''
 
-    input_format, orig_sample_rate = _probe_audio(input_stream)
-    sample_rate = orig_sample_rate * pitch_scaler
-    filters = _construct_filters(tempo_scaler, orig_sample_rate, sample_rate)
+    def convert(self, input_stream: BinaryIO, output_streams: Dict[str, BinaryIO], tempo_scaler: float, pitch_scaler: float,
+                input_format: str, orig_sample_rate: int, threads: int, report: Optional[Callable[[float], None]],
+                preview: Optional[float] = None):
+        '''
+        Converts input_stream to every format in output_streams. Arguments are as for convert_audio_outputs.
+
+        :param report: Called with the position in the output in seconds, if not None
+        :param preview: Passed on to encode_audio
+        '''
+        raise NotImplementedError
+
+
+class FFmpegEngine(DspEngine):
+    '''
+    Runs the whole conversion in one ffmpeg process, using its atempo, asetrate and aresample filters.
+    '''
+
+    def convert(self, input_stream: BinaryIO, output_streams: Dict[str, BinaryIO], tempo_scaler: float, pitch_scaler: float,
+                input_format: str, orig_sample_rate: int, threads: int, report: Optional[Callable[[float], None]],
+                preview: Optional[float] = None):
+        filters = _construct_filters(
+            tempo_scaler, orig_sample_rate, orig_sample_rate * pitch_scaler)
+
+        encode_audio(('-f', input_format, '-i', 'pipe:'), filters,
+                     input_stream, output_streams, threads, report, preview)
+
+
+_dsp_engine = None
+
+
+def dsp_engine() -> DspEngine:
+    '''
+    Returns the engine selected by DSP_ENGINE. The numpy engine is only imported if it is used.
+    '''
+    global _dsp_engine
+
+    if _dsp_engine is None:
+        if DSP_ENGINE == 'numpy':
+            from ncconv.dsp import NumpyEngine
+            _dsp_engine = NumpyEngine()
+        elif DSP_ENGINE == 'ffmpeg':
+            _dsp_engine = FFmpegEngine()
+        else:
+            raise ValueError(f'Unknown DSP_ENGINE {DSP_ENGINE}')
+
+    return _dsp_engine
+
+
+def _encoder_args(input_args: Tuple[str, ...], filters: str, output_formats: List[str], pipes: List[int],
+                  threads: int, preview: Optional[float]) -> Tuple[str, ...]:
+    '''
+    The command line for encode_audio. The first output goes to stdout, the others to the write ends of pipes.
+    '''
+    encoders = [__ffmpeg_formats[output_format]
+                for output_format in output_formats]
+    urls = ['pipe:1', *(f'pipe:{w}' for w in pipes)]
+
+    if len(encoders) == 1:
+        graph = ('-af', filters)
+        maps = [()]
+    else:
+        labels = [f'[o{i}]' for i in range(len(encoders))]
+        graph = ('-filter_complex',
+                 f'[0:a]{filters},asplit={len(encoders)}{"".join(labels)}')
+        maps = [('-map', label) for label in labels]
+
+    outputs = []
+    for (output_format, output_codec, muxer_opts), url, output_map in zip(encoders, urls, maps):
+        outputs += [*output_map, '-threads', str(threads), '-c:a', output_codec,
+                    *(('-b:a', __preview_bitrates[output_codec], '-t', str(preview)) if preview else ()),
+                    *muxer_opts, '-f', output_format, url]
+
+    return (FFMPEG_EXEC, '-v', 'error', '-nostats', '-progress', 'pipe:2', '-threads', str(threads),
+            '-filter_threads', str(threads), '-filter_complex_threads', str(threads),
+            *input_args, '-vn', *graph, *outputs)
+
+
+def encode_audio(input_args: Tuple[str, ...], filters: str, input_stream: BinaryIO, output_streams: Dict[str, BinaryIO],
+                 threads: int = 0, report: Optional[Callable[[float], None]] = None, preview: Optional[float] = None):
+    '''
+    Runs ffmpeg on input_stream, applies filters and encodes the result to every format in output_streams.
+    The filtered audio is split between one encoder per format.
+
+    :param input_args: ffmpeg options describing the input, which is read from stdin
+    :param filters: Audio filters to apply before encoding. anull for none.
+    :param input_stream: What to feed ffmpeg
+    :param output_streams: Maps each output format (m4a or ogg) to where to write it
+    :param threads: How many threads ffmpeg may use. 0 lets ffmpeg decide.
+    :param report: Called with the position in the output in seconds
+    :param preview: If given, ffmpeg stops after this many seconds of output, which is encoded at a low bitrate
+    '''
+    # The first output goes to stdout, any others to pipes of their own
+    pipes = [os.pipe() for _ in list(output_streams)[1:]]
+
+    # Perform the conversion! Wow!
     try:
-        output_format, output_codec = __ffmpeg_formats[output_format]
-    except KeyError:
+        proc = subprocess.Popen(_encoder_args(input_args, filters, list(output_streams), [w for _, w in pipes], threads, preview),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                pass_fds=[w for _, w in pipes])
+    except BaseException:
+        for r, _ in pipes:
+            os.close(r)
+        raise
+    finally:
+        # only ffmpeg writes to them, so that we see the end of each output when it exits
+        for _, w in pipes:
+            os.close(w)
+
+    with proc:
+        feeder = _Feeder(input_stream, proc.stdin)
+        feeder.start()
+        # stderr has to be drained as well, or a chatty ffmpeg would stall
+        stderr = _StderrReader(proc.stderr, report)
+        stderr.start()
+        # every output is read at the same time, ffmpeg writes them in lockstep
+        collectors = [_Collector(proc, src, dst) for src, dst in zip(
+            [proc.stdout, *(os.fdopen(r, 'rb') for r, _ in pipes)], output_streams.values())]
+        for collector in collectors:
+            collector.start()
+
+        try:
+            proc.wait()
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.wait()
+            feeder.join()
+            stderr.join()
+            for collector in collectors:
+                collector.join()
+
+    for collector in collectors:
+        if collector.error:
+            raise collector.error
+
+    if feeder.error:
+        raise feeder.error
+
+    if proc.returncode != 0:
+        print(b''.join(stderr.errors))
+        raise HTTPException(
+            status_code=500, detail='Audio conversion failed')
+
+
+async def convert_audio_outputs_async(input_stream: Any, output_streams: Dict[str, Any], tempo_scaler: float = DEFAULT_TEMPO, pitch_scaler: float = DEFAULT_PITCH,
+                                      input_format: Optional[str] = None, orig_sample_rate: Optional[int] = None, threads: int = 0,
+                                      duration: Optional[float] = None, progress_cb: Optional[Callable[[float], None]] = None,
+                                      preview: Optional[float] = None):
+    '''
+    Same as convert_audio_outputs, but doesn't block the event loop. The input is read with await input_stream.read(n)
+    and the outputs are written with await output_stream.write(buf).
+
+    The transform is always done by ffmpeg's filters, whatever DSP_ENGINE says.
+    '''
+
+    if not input_format or not orig_sample_rate:
+        input_format, orig_sample_rate, *_ = await probe_audio(await input_stream.read(PROBE_SIZE))
+        input_stream.seek(0)
+
+    if any(output_format not in __ffmpeg_formats for output_format in output_streams):
         raise HTTPException(
             status_code=400, detail='Unsupported output format')
 
-    # We can't just read stdout because the mp4 muxer doesn't support non-seekable outputs
-    with TemporaryDirectory() as td:
-        tfp = os.path.join(td, 'output')
-        # Perform the conversion! Wow!
-        proc = subprocess.run((FFMPEG_EXEC, '-i', 'pipe:', '-f', input_format, '-c:a', output_codec,
-                              '-vn', '-f', output_format, '-af', filters, tfp), input=input_stream, capture_output=True)
+    filters = _construct_filters(
+        tempo_scaler, orig_sample_rate, orig_sample_rate * pitch_scaler)
 
-        if proc.returncode != 0:
-            print(proc.stderr)
-            raise HTTPException(
-                status_code=500, detail='Audio conversion failed')
+    await encode_audio_async(('-f', input_format, '-i', 'pipe:'), filters, input_stream, output_streams, threads,
+                             _reporter(tempo_scaler, pitch_scaler, duration, progress_cb), preview)
 
-        if os.stat(tfp).st_size > MAX_ARTIFACT_SIZE:
-            raise HTTPException(
-                status_code=400, detail='Resulting file exceeded the size limit.')
 
-        with open(tfp, 'rb') as fp:
-            return fp.read()
+async def encode_audio_async(input_args: Tuple[str, ...], filters: str, input_stream: Any, output_streams: Dict[str, Any],
+                             threads: int = 0, report: Optional[Callable[[float], None]] = None, preview: Optional[float] = None):
+    '''
+    Same as encode_audio, but on the event loop. ffmpeg is fed, and every one of its outputs is read, at the same time.
+
+    :param input_stream: What to feed ffmpeg, read with await input_stream.read(n)
+    :param output_streams: Maps each output format to where to write it with await output_stream.write(buf)
+    '''
+    pipes = [os.pipe() for _ in list(output_streams)[1:]]
+
+    try:
+        proc = await asyncio.create_subprocess_exec(*_encoder_args(input_args, filters, list(output_streams), [w for _, w in pipes], threads, preview),
+                                                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE, pass_fds=[w for _, w in pipes])
+    except BaseException:
+        for r, _ in pipes:
+            os.close(r)
+        raise
+    finally:
+        # only ffmpeg writes to them, so that we see the end of each output when it exits
+        for _, w in pipes:
+            os.close(w)
+
+    loop = asyncio.get_running_loop()
+    pipe_files = [os.fdopen(r, 'rb') for r, _ in pipes]
+    sources, transports = [proc.stdout], []
+    errors = deque(maxlen=20)
+
+    async def feed():
+        try:
+            while (buf := await input_stream.read(_PIPE_CHUNK)):
+                proc.stdin.write(buf)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg stopped reading, it does this if it fails
+        finally:
+            proc.stdin.close()
+
+    async def drain_stderr():
+        # stderr has to be drained as well, or a chatty ffmpeg would stall
+        while (line := await proc.stderr.readline()):
+            _stderr_line(line, errors, report)
+
+    async def collect(src: asyncio.StreamReader, dst: Any):
+        written = 0
+
+        try:
+            while (buf := await src.read(_PIPE_CHUNK)):
+                written += len(buf)
+                if written > MAX_ARTIFACT_SIZE:
+                    raise HTTPException(
+                        status_code=400, detail='Resulting file exceeded the size limit.')
+
+                await dst.write(buf)
+        except BaseException:
+            # nobody would be reading its output anymore
+            with suppress(ProcessLookupError):
+                proc.kill()
+            raise
+
+    tasks = []
+
+    try:
+        for pipe_file in pipe_files:
+            reader = asyncio.StreamReader()
+            transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe_file)
+            sources.append(reader)
+            transports.append(transport)
+
+        feeder = asyncio.ensure_future(feed())
+        stderr = asyncio.ensure_future(drain_stderr())
+        # every output is read at the same time, ffmpeg writes them in lockstep
+        collectors = [asyncio.ensure_future(collect(src, dst))
+                      for src, dst in zip(sources, output_streams.values())]
+        tasks = [feeder, stderr, *collectors]
+
+        await proc.wait()
+        await asyncio.wait(tasks)
+    except BaseException:
+        with suppress(ProcessLookupError):
+            proc.kill()
+
+        for task in tasks:
+            task.cancel()
+
+        if tasks:
+            await asyncio.wait(tasks)
+        await proc.wait()
+        raise
+    finally:
+        for transport in transports:
+            transport.close()
+        for pipe_file in pipe_files:
+            pipe_file.close()
+
+    for collector in collectors:
+        if collector.exception():
+            raise collector.exception()
+
+    if feeder.exception():
+        raise feeder.exception()
+
+    if proc.returncode != 0:
+        print(b''.join(errors))
+        raise HTTPException(
+            status_code=500, detail='Audio conversion failed')
@@ -0,0 +1,509 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# jobs.py - What the workers do with MongoDB and GridFS: claiming jobs, holding
+# their leases and recording their results. Shared by both worker engines, which
+# run it with pymongo or Motor (see steps.py) and differ in how they run ffmpeg.
+
+
+from contextlib import suppress
+from datetime import datetime, timedelta, timezone
+from os import getpid, path
+import re
+from socket import gethostname
+from threading import Event, Lock
+from time import monotonic, perf_counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+from gridfs.errors import NoFile
+import sentry_sdk
+
+from ncconv.admission import record_service_time
+from ncconv.ccache import cache_key, cache_lookup, cache_store
+from ncconv.config import LEASE_DURATION, MAX_ATTEMPTS, QUEUE_POLL_INTERVAL, SENTRY_DSN
+from ncconv.diskstore import DiskStore, DiskWriter
+from ncconv.metrics import ENCODE_TIME, JOB_WAIT, UPLOAD_TIME
+from ncconv.recents import artifact_inserted
+from ncconv.steps import Steps, blocking, run_steps
+
+
+# Identifies this process in the leases it holds
+lease_owner = f'{gethostname()}:{getpid()}'
+
+
+def _lease_update(now: datetime) -> dict:
+    return {
+        '$set': {'state': 1, 'lease_owner': lease_owner, 'lease_expires': now + timedelta(seconds=LEASE_DURATION)},
+        '$inc': {'attempts': 1}
+    }
+
+
+def _lease(doc: dict) -> dict:
+    '''
+    The filter that matches a claimed job for as long as we hold it.
+    '''
+    return {'_id': doc['_id'], 'lease_owner': doc['lease_owner'], 'attempts': doc['attempts']}
+
+
+def preview_claim(now: datetime) -> Tuple[dict, dict]:
+    '''
+    The filter that finds the next preview and the update that claims it, for claim_next.
+    '''
+    # Never retried, the client has given up on it by the time its lease would expire
+    return {'state': 0, 'preview': True}, _lease_update(now)
+
+
+def job_claim(now: datetime) -> Tuple[dict, dict]:
+    '''
+    The filter that finds the next conversion and the update that claims it, for claim_next.
+    '''
+    return (
+        {'preview': {'$ne': True}, '$or': [
+            {'state': 0},
+            # the worker converting this one has died
+            {'state': 1, 'lease_expires': {'$lt': now},
+                'attempts': {'$lt': MAX_ATTEMPTS}}
+        ]},
+        _lease_update(now)
+    )
+
+
+def claim_next(db, claim: Callable[[datetime], Tuple[dict, dict]]) -> Steps[Optional[dict]]:
+    '''
+    Claims the job that has waited the longest, or returns None if there is none. Atomic with respect to the job.
+    A step generator (see steps.py), like everything here that goes to the database.
+
+    :param db: Database reference
+    :param claim: preview_claim or job_claim
+    '''
+    return (yield db.queue.find_one_and_update(*claim(datetime.now(timezone.utc)),
+                                        sort=[('sched_time', 1), ('_id', 1)],
+                                        return_document=ReturnDocument.AFTER))
+
+
+def fail_stuck_jobs(db) -> Steps[None]:
+    '''
+    Fails the jobs whose lease expired too many times, in case they are what keeps killing the workers,
+    and the previews whose lease expired at all. The upload is left for the reaper.
+    '''
+    yield db.queue.update_many({'state': 1, 'lease_expires': {'$lt': datetime.now(timezone.utc)}, '$or': [
+        {'attempts': {'$gte': MAX_ATTEMPTS}},
+        {'preview': True}
+    ]}, {
+        '$set': {'state': 3, 'status_code': 500, 'detail': 'Your file could not be converted. Try again!'},
+        '$unset': {'pending_file': '', 'lease_owner': '', 'lease_expires': ''}
+    })
+
+
+def extend_lease(db, lease: dict) -> Steps[bool]:
+    '''
+    Keeps other workers from taking a job over for another LEASE_DURATION. Returns False if the lease is lost,
+    because the job is gone or someone else has it.
+
+    :param lease: The filter that matches the job while we hold it
+    '''
+    try:
+        return bool((yield db.queue.update_one({**lease, 'state': 1}, {'$set': {
+            'lease_expires': datetime.now(timezone.utc) + timedelta(seconds=LEASE_DURATION)}})).matched_count)
+    except Exception as e:
+        print(e)
+
+        return True  # try again next time
+
+
+# Error codes meaning that the server won't give us a change stream (standalone mongod, missing privileges)
+no_change_streams = (13, 40573)
+
+
+def watch_queue(db, wake, stop: Event):
+    '''
+    Sets wake whenever a job is enqueued, until stop is set. Runs in a thread of its own.
+
+    Uses a change stream on the queue collection. Change streams need a replica set, so on a standalone
+    mongod this falls back to setting wake every QUEUE_POLL_INTERVAL seconds.
+
+    :param db: Database reference (pymongo)
+    :param wake: Anything with a set method that is safe to call from this thread
+    :param stop: Event to stop on
+    '''
+
+    while not stop.is_set():
+        try:
+            with db.queue.watch([{'$match': {'operationType': 'insert'}}], max_await_time_ms=1000) as stream:
+                # anything enqueued before the stream was opened would be missed otherwise
+                wake.set()
+
+                while not stop.is_set():
+                    if stream.try_next():
+                        wake.set()
+        except OperationFailure as e:
+            if e.code in no_change_streams:
+                break
+
+            print(e)
+        except Exception as e:
+            if SENTRY_DSN:
+                sentry_sdk.capture_exception(e)
+
+            print(e)
+
+        # Jobs may have been enqueued while the stream was down
+        stop.wait(1)
+        wake.set()
+
+    while not stop.wait(QUEUE_POLL_INTERVAL):
+        wake.set()
+
+
+class CpuBudget:
+    '''
+    Splits a number of threads between the conversions that are running at the same time.
+    '''
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.allotted = 0
+        self.running = 0
+        self.lock = Lock()
+
+    def take(self) -> int:
+        '''
+        Returns how many threads the conversion that is about to start may use. Must be given back when it is done.
+        '''
+        with self.lock:
+            self.running += 1
+            # An even share, but no more than what's left over. Every conversion needs at least one thread.
+            n = max(1, min(self.threads // self.running,
+                    self.threads - self.allotted))
+            self.allotted += n
+
+            return n
+
+    def give_back(self, n: int):
+        with self.lock:
+            self.running -= 1
+            self.allotted -= n
+
+
+def _record_progress(db, task_id, percent: float) -> Steps[None]:
+    try:
+        yield db.queue.update_one({'_id': task_id, 'state': 1}, {
+                            '$set': {'progress': round(percent, 1)}})
+    except Exception as e:
+        print(e)
+
+
+def progress_reporter(db, task_id, run: Callable[[Steps[None]], None] = run_steps) -> Callable[[float], None]:
+    '''
+    Returns a callback for convert_audio that records the progress of a job on its queue document, at most once a second.
+
+    :param db: Database reference
+    :param task_id: The job's _id
+    :param run: Runs the update. Right away by default, the asyncio workers leave it to a task of its own.
+    '''
+    last = 0
+
+    def report(percent: float):
+        nonlocal last
+
+        if monotonic() - last >= 1:
+            last = monotonic()
+            run(_record_progress(db, task_id, percent))
+
+    return report
+
+
+def _failure(e: Exception, detail: str) -> Tuple[int, str]:
+    '''
+    The status code and message a failed job reports.
+
+    :param detail: What to tell the user if the error isn't an HTTPException
+    '''
+    if isinstance(e, HTTPException):
+        return e.status_code, e.detail
+
+    return 500, detail
+
+
+def _open_pending(bucket, file_id) -> Steps[Any]:
+    try:
+        return (yield bucket.open_download_stream(file_id))
+    except NoFile:
+        raise HTTPException(
+            status_code=404, detail='No such pending file')
+
+
+class TimedWriter:
+    '''
+    Passes writes on to a GridFS file, adding up how long they take, and to a copy on disk if there is one.
+    '''
+
+    def __init__(self, dst: Any, copy: Optional[DiskWriter] = None):
+        self.dst, self.copy, self.seconds = dst, copy, 0.0
+
+    def write(self, buf: bytes):
+        started = perf_counter()
+        self.dst.write(buf)
+        self.seconds += perf_counter() - started
+
+        if self.copy:
+            self.copy.write(buf)
+
+
+def _artifact_filename(filename: str, output_format: str) -> str:
+    '''
+    Renames and escapes the filename of an upload for its converted file.
+    '''
+    fn = re.sub(r'(?u)[^-\w.]', '', filename.strip().replace(' ', '_'))
+
+    return path.splitext(fn)[0] + '.night' + ('.m4a' if output_format == 'm4a' else '.ogg')
+
+
+
+
+class Job:
+    '''
+    A claimed conversion, from looking it up in the conversion cache to recording its results. Every method is a
+    step generator.
+
+    The worker calls start, converts the input it returns into writers (unless everything was cached), then calls
+    finish, or abort and fail if converting failed, and close in any case. While it holds the job, it has to keep
+    extending the lease with extend_lease. Writes to the job only go through while it does.
+    '''
+
+    def __init__(self, db, bucket, doc: dict, store: Optional[DiskStore], writer: Callable[..., TimedWriter] = TimedWriter):
+        '''
+        :param db: Database reference, pymongo or Motor
+        :param bucket: The music GridFSBucket of db
+        :param doc: The claimed queue document
+        :param store: Where converted files are copied to, if anywhere
+        :param writer: Makes the writers, which the asyncio workers write to with await
+        '''
+        self.db, self.bucket, self.doc, self.store = db, bucket, doc, store
+        self.writer = writer
+        self.lease = _lease(doc)
+        # Jobs enqueued before multiple formats could be requested have a single one
+        self.output_formats = doc.get('output_formats') or [doc['output_format']]
+        self.expire_time = datetime.now(timezone.utc) + timedelta(days=1)
+        # Jobs enqueued before the input was hashed can't use the cache
+        self.keys = {output_format: cache_key(doc['input_hash'], doc['scale_pitch'], doc['scale_tempo'], output_format)
+                     for output_format in self.output_formats} if 'input_hash' in doc else {}
+        # output format -> artifact
+        self.results = {}
+        # output format -> where it is being converted to, for the formats that weren't cached
+        self.grid_ins: Dict[str, Any] = {}
+        self.writers: Dict[str, TimedWriter] = {}
+        self.owned = False
+
+    def start(self) -> Steps[Optional[Any]]:
+        '''
+        Looks the job up in the conversion cache. Returns the input, or None if every format was cached already.
+        '''
+        # a job that is retried has already been counted
+        if self.doc['attempts'] == 1:
+            JOB_WAIT.observe((datetime.now(timezone.utc) -
+                             self.doc['_id'].generation_time).total_seconds())
+
+        for output_format, key in self.keys.items():
+            if (cached := (yield from cache_lookup(self.db, key, self.expire_time))):
+                self.results[output_format] = cached
+
+        if not (missing := [output_format for output_format in self.output_formats if output_format not in self.results]):
+            return None
+
+        f = yield from _open_pending(self.bucket, self.doc['pending_file'])
+
+        # the results are uploaded as they are produced
+        self.grid_ins = {output_format: self.bucket.open_upload_stream(_artifact_filename(f.filename, output_format), metadata={
+            'content_type': 'audio/mp4' if output_format == 'm4a' else 'audio/ogg',
+            'expire_time': self.expire_time,
+            'uploaded_by': str(self.doc['enqueued_by'])
+        }) for output_format in missing}
+        # Converted files are copied to disk while they are uploaded, so that the first download doesn't have to read them back
+        for output_format, grid_in in self.grid_ins.items():
+            self.writers[output_format] = self.writer(grid_in, (yield blocking(self.store.writer)) if self.store else None)
+
+        return f
+
+    def abort(self) -> Steps[None]:
+        '''
+        Drops what was converted so far.
+        '''
+        for grid_in in self.grid_ins.values():
+            yield grid_in.abort()
+
+        for writer in self.writers.values():
+            if writer.copy:
+                yield blocking(writer.copy.abort)
+
+    def finish(self, seconds: float = 0) -> Steps[None]:
+        '''
+        Stores the converted files and marks the job as done, so that a client calling /check can see them.
+
+        :param seconds: How long converting took
+        '''
+        closing = monotonic()
+        # the formats that were converted
+        converted = {}
+
+        for output_format, grid_in in self.grid_ins.items():
+            yield grid_in.close()
+            converted[output_format] = self.results[output_format] = grid_in._id
+
+        if converted:
+            ENCODE_TIME.observe(seconds)
+            UPLOAD_TIME.observe(sum(w.seconds for w in self.writers.values()) + monotonic() - closing)
+
+        completed_files = [self.results[output_format]
+                           for output_format in self.output_formats]
+
+        self.owned = (yield self.db.queue.replace_one(self.lease, {
+            '_id': self.doc['_id'],
+            'state': 2,
+            'completed_file': completed_files[0],
+            'completed_files': completed_files,
+            'expire_time': self.doc['expire_time']
+        })).matched_count
+
+        # the formats were encoded side by side, so each gets a share of the time
+        encode_seconds = seconds / len(converted) if converted else 0
+
+        for output_format, file_id in converted.items():
+            if not self.owned:
+                # Another worker took the job over, its results will be used instead
+                with suppress(NoFile):
+                    yield self.bucket.delete(file_id)
+            elif output_format in self.keys:
+                yield from cache_store(self.db, self.keys[output_format], file_id, self.expire_time, encode_seconds)
+
+            if (copy := self.writers[output_format].copy):
+                if self.owned:
+                    yield blocking(copy.commit, file_id)
+                else:
+                    yield blocking(copy.abort)
+
+        if self.owned and converted:
+            yield from artifact_inserted(self.db)
+
+            if self.doc.get('duration'):
+                yield from record_service_time(self.db, 'convert', encode_seconds / self.doc['duration'])
+
+    def fail(self, e: Exception) -> Steps[None]:
+        '''
+        Marks the job as failed, with what went wrong.
+        '''
+        status_code, detail = _failure(e, 'An unexpected error occurred during the conversion of your file. Try again!')
+
+        self.owned = (yield self.db.queue.replace_one(self.lease, {
+            'state': 3,
+            'status_code': status_code,
+            'detail': detail,
+            'expire_time': self.doc['expire_time']
+        })).matched_count
+
+    def close(self) -> Steps[None]:
+        # If another worker took the job over, it still needs the upload
+        if self.owned:
+            with suppress(Exception):
+                yield self.bucket.delete(self.doc['pending_file'])
+
+
+# Previews are read back while they are being converted, so they are stored in small chunks that show up soon
+_PREVIEW_CHUNK = 16 * 1024
+# How often the lease on a preview is extended, in seconds. A preview whose client went away is cancelled, which its
+# worker finds out about by failing to extend the lease, so this is how long it may go on converting for nobody.
+PREVIEW_HEARTBEAT = 1
+
+
+class PreviewWriter:
+    '''
+    Passes writes on to the GridFS file of a preview, until the preview is cancelled.
+    '''
+
+    def __init__(self, dst: Any, job: 'PreviewJob'):
+        self.dst, self.job = dst, job
+
+    def write(self, buf: bytes):
+        self.job.check()
+        self.dst.write(buf)
+
+
+class PreviewJob:
+    '''
+    A claimed preview, used like Job, lease and all. Previews are never retried.
+
+    The HTTP server cancels a preview that a worker holds by setting cancelled on it, rather than deleting its file
+    while chunks are still written to it. That breaks the lease, so the worker calls lost once it fails to extend it,
+    stops converting, and deletes what it wrote itself.
+    '''
+
+    def __init__(self, db, bucket, doc: dict, writer: Callable[..., PreviewWriter] = PreviewWriter):
+        self.db, self.bucket, self.doc, self.writer = db, bucket, doc, writer
+        self.lease = {**_lease(doc), 'cancelled': {'$ne': True}}
+        self.started = monotonic()
+        self.grid_in = None
+        self.cancelled = False
+
+    def lost(self):
+        '''
+        Tells the conversion to stop, as the lease was lost. Safe to call from any thread.
+        '''
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise HTTPException(status_code=410, detail='The preview was cancelled.')
+
+    def start(self) -> Steps[Tuple[Any, PreviewWriter]]:
+        '''
+        Returns the input, and a writer for the file that the client is reading the preview from.
+        '''
+        f = yield from _open_pending(self.bucket, self.doc['pending_file'])
+
+        output_format = self.doc['output_format']
+        self.grid_in = self.bucket.open_upload_stream_with_id(self.doc['preview_file'], 'preview.' + output_format,
+                                                              chunk_size_bytes=_PREVIEW_CHUNK, metadata={
+                                                                  'content_type': 'audio/mp4' if output_format == 'm4a' else 'audio/ogg',
+                                                                  'expire_time': self.doc['expire_time'],
+                                                                  'preview': True
+                                                              })
+
+        return f, self.writer(self.grid_in, self)
+
+    def abort(self) -> Steps[None]:
+        yield self.grid_in.abort()
+
+    def finish(self) -> Steps[None]:
+        yield self.grid_in.close()
+
+        if not (yield self.db.queue.update_one(self.lease, {'$set': {'state': 2}})).matched_count:
+            yield from self._discard()
+            return
+
+        yield from record_service_time(self.db, 'preview', monotonic() - self.started)
+
+    def fail(self, e: Exception) -> Steps[None]:
+        status_code, detail = _failure(e, 'An unexpected error occurred while previewing your file. Try again!')
+
+        if not (yield self.db.queue.update_one(self.lease, {'$set': {
+                'state': 3, 'status_code': status_code, 'detail': detail}})).matched_count:
+            yield from self._discard()
+
+    def _discard(self) -> Steps[None]:
+        # Nobody is reading a preview that was cancelled, and nobody else deletes it
+        with suppress(NoFile):
+            yield self.bucket.delete(self.doc['preview_file'])
+
+        yield self.db.queue.delete_one({'_id': self.doc['_id'], 'cancelled': True})
+
+    def close(self) -> Steps[None]:
+        with suppress(Exception):
+            yield self.bucket.delete(self.doc['pending_file'])
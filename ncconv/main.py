@@ -11,11 +11,12 @@
 
 
 from threading import Thread
-from queue import Queue
+from queue import SimpleQueue
 import shutil
 import sys
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 from fastapi.middleware.cors import CORSMiddleware
@@ -25,13 +26,82 @@ from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from sentry_sdk import init as sentry_init
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from brotli_asgi import BrotliMiddleware
+from starlette.datastructures import Headers
 
-from ncconv.config import FFMPEG_EXEC, FFPROBE_EXEC, MONGO_URI, BIND_HTTP_PORT, BIND_HTTP_IP, HOSTS, TRUSTED_PROXIES, HTTP_WORKERS, MONGO_DB, CORS_HOSTS, VERSION, SENTRY_DSN
+from ncconv.config import FFMPEG_EXEC, FFPROBE_EXEC, MONGO_URI, BIND_HTTP_PORT, BIND_HTTP_IP, HOSTS, TRUSTED_PROXIES, HTTP_WORKERS, MONGO_DB, CORS_HOSTS, VERSION, SENTRY_DSN, QUEUE_SNAPSHOT_INTERVAL, ARTIFACT_CACHE_SIZE, EMBEDDED_WORKERS, METRICS_DIR, MAX_UPLOAD_SIZE, WORKER_ENGINE, FFMPEG_WORKERS, FFMPEG_THREADS, PREVIEW_WORKERS
+from ncconv.aworkers import afftask
 from ncconv.cworkers import fftask
+from ncconv.artifacts import ArtifactCache
+from ncconv.diskstore import disk_store
+from ncconv.queuepos import QueueSnapshot
+from ncconv.recents import Recents
 from ncconv.reaper import reaper_task
 from ncconv.routes.media import media_router
 from ncconv.routes.convert import convert_router
+from ncconv.routes.metrics import metrics_router
+
+
+class _Compression(BrotliMiddleware):
+    '''
+    BrotliMiddleware that leaves some responses alone. Its gzip fallback holds streamed responses back
+    until enough has been written, which would delay server-sent events. Audio doesn't compress, and
+    compressing part of a file would make its Content-Range meaningless.
+    '''
+    uncompressed = ('/convert/events/', '/media/file/')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(self.uncompressed):
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+
+class _BodyLimit:
+    '''
+    Refuses request bodies larger than limit with 413. Starlette reads a whole form into a temporary file before
+    the route gets to see it, so this is what stops a large upload early, whether or not it has a Content-Length.
+    '''
+
+    def __init__(self, app, limit: int):
+        self.app, self.limit = app, limit
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        length = Headers(scope=scope).get('content-length', '')
+        if length.isdigit() and int(length) > self.limit:
+            await self._refuse(scope, receive, send)
+            return
+
+        received, refused = 0, False
+
+        async def limited_receive():
+            nonlocal received, refused
+            message = await receive()
+
+            if message['type'] == 'http.request' and not refused:
+                received += len(message.get('body', b''))
+
+                if received > self.limit:
+                    refused = True
+                    await self._refuse(scope, receive, send)
+                    # Makes the app give up on the body. What it responds with is dropped below
+                    return {'type': 'http.disconnect'}
+
+            return message
+
+        async def send_unless_refused(message):
+            if not refused:
+                await send(message)
+
+        await self.app(scope, limited_receive, send_unless_refused)
+
+    async def _refuse(self, scope, receive, send):
+        await ORJSONResponse({'detail': 'Your file is too large.'}, status_code=413)(scope, receive, send)
 
 
 api = FastAPI(docs_url=None, redoc_url=None)
@@ -40,13 +110,16 @@ api = FastAPI(docs_url=None, redoc_url=None)
 api.add_middleware(TrustedHostMiddleware, allowed_hosts=HOSTS)
 # This is important so that our rate limiting hits actual client IP addresses
 api.add_middleware(ProxyHeadersMiddleware, trusted_hosts=TRUSTED_PROXIES)
+# Leaves room for the other form fields, the file itself is checked against MAX_UPLOAD_SIZE by the route
+api.add_middleware(_BodyLimit, limit=MAX_UPLOAD_SIZE + 64 * 1024)
 api.add_middleware(CORSMiddleware, allow_origins=CORS_HOSTS, allow_methods=[
-                   'GET', 'POST'], allow_headers=['Content-Length'], max_age=3600, expose_headers=['Retry-After'])
-api.add_middleware(BrotliMiddleware, gzip_fallback=True, minimum_size=400)
+                   'GET', 'POST'], allow_headers=['Content-Length', 'Range'], max_age=3600, expose_headers=['Retry-After', 'Content-Range', 'ETag'])
+api.add_middleware(_Compression, gzip_fallback=True, minimum_size=400)
 
 # Add subrouters
 api.include_router(media_router)
 api.include_router(convert_router)
+api.include_router(metrics_router)
 
 
 # Serve the web app
@@ -77,6 +150,20 @@ if SENTRY_DSN:
     app.add_middleware(SentryAsgiMiddleware)
 
 
+async def _ttl_index(collection, field: str, seconds: int):
+    '''
+    Creates a TTL index, or changes the expiry of an existing one
+    '''
+    try:
+        await collection.create_index([(field, 1)], expireAfterSeconds=seconds)
+    except OperationFailure as e:
+        if e.code != 85:  # IndexOptionsConflict
+            raise
+
+        await collection.database.command('collMod', collection.name, index={
+            'keyPattern': {field: 1}, 'expireAfterSeconds': seconds})
+
+
 # Events do not get called for mounted apps
 @app.on_event('startup')
 async def initialize():
@@ -84,13 +171,28 @@ async def initialize():
     api.state.db = AsyncIOMotorClient(MONGO_URI)[MONGO_DB]
     api.state.file_store = AsyncIOMotorGridFSBucket(
         api.state.db, bucket_name="music")
+    api.state.queue_snapshot = QueueSnapshot(QUEUE_SNAPSHOT_INTERVAL)
+    api.state.recents = Recents(1, 60)
+    api.state.artifact_cache = ArtifactCache(ARTIFACT_CACHE_SIZE, 1)
+    api.state.disk_store = disk_store()
 
     # Setup indexes
 
-    # This will destroy the file (and link) but not free the storage!
-    # The reaper will clean up orphaned chunks later
-    await api.state.db.music.files.create_index([("metadata.expire_time", 1)], expireAfterSeconds=0)
+    # The reaper deletes expired files together with their chunks. This is only a backstop for when it isn't running.
+    # It will destroy the file (and link) but not free the storage, the reaper cleans up orphaned chunks later
+    await _ttl_index(api.state.db.music.files, 'metadata.expire_time', 3600)
+    # Used by the reaper to find uploads that nobody is waiting for anymore, and for the recents
+    await api.state.db.music.files.create_index([('metadata.pending', 1), ('uploadDate', -1)])
+    await api.state.db.queue.create_index([('pending_file', 1)])
     await api.state.db.queue.create_index([('expire_time', 1)], expireAfterSeconds=0)
+    # Used by the workers to claim the next job
+    await api.state.db.queue.create_index([('state', 1), ('sched_time', 1)])
+    # Where the line of each client ends, forgotten once that is in the past
+    await api.state.db.fairqueue.create_index([('finish', 1)], expireAfterSeconds=0)
+    # Workers that stopped announcing themselves
+    await api.state.db.workers.create_index([('expires', 1)], expireAfterSeconds=0)
+    # Conversion cache entries go away with the artifact they point to
+    await api.state.db.convcache.create_index([('expire_time', 1)], expireAfterSeconds=0)
 
     # If the client does not check the status of the queued item within 30 seconds
     # we assume they've lost interest and delete the item (navigated away, etc)
@@ -99,6 +201,7 @@ async def initialize():
     # Rate limits
     await api.state.db.ratelimits.create_index([('bucket_expires', 1)], expireAfterSeconds=0)
     await api.state.db.ratelimits.create_index([('ip', 1), ('key', 1)], unique=True)
+    await api.state.db.ratelimit_spent.create_index([('expires', 1)], expireAfterSeconds=0)
 
 
 if __name__ == '__main__':
@@ -107,20 +210,38 @@ if __name__ == '__main__':
         print('FATAL: ffmpeg or ffprobe was not found in PATH. Install them and try again.')
         sys.exit(1)
 
+    if WORKER_ENGINE not in ('threads', 'asyncio'):
+        print(f'FATAL: Unknown WORKER_ENGINE {WORKER_ENGINE}, use threads or asyncio.')
+        sys.exit(1)
+
+    if HTTP_WORKERS > 1 and not METRICS_DIR:
+        print('WARNING: METRICS_DIR is not set, so /api/metrics will only show part of what the processes recorded.')
+
     # Create threads for ffmpeg
-    # sync db handle
-    db = MongoClient(MONGO_URI)[MONGO_DB]
+    q = SimpleQueue()
+
+    # Otherwise, conversions are left to python3 -m ncconv.worker
+    if WORKER_ENGINE == 'asyncio':
+        # Reaps as well, with a Motor client of its own
+        my_threads = [Thread(target=afftask, args=(q, None, FFMPEG_WORKERS if EMBEDDED_WORKERS else 0, FFMPEG_THREADS,
+                                                   PREVIEW_WORKERS if EMBEDDED_WORKERS else 0, True), name='fftask-0')]
+    else:
+        # sync db handle
+        db = MongoClient(MONGO_URI)[MONGO_DB]
+
+        my_threads = [Thread(target=reaper_task, args=(q, db), name='reaper-task')]
 
-    q = Queue()
-    ffthread = Thread(target=fftask, args=(q, db), name='fftask-0').start()
+        if EMBEDDED_WORKERS:
+            my_threads.append(
+                Thread(target=fftask, args=(q, db), name='fftask-0'))
 
-    reaper_thread = Thread(target=reaper_task, args=(
-        q, db), name='reaper-task').start()
+    for t in my_threads:
+        t.start()
 
     run('ncconv.main:app', host=BIND_HTTP_IP, port=BIND_HTTP_PORT,
         log_level='info', workers=HTTP_WORKERS)
 
-    for x in range(2):
+    for t in my_threads:
         q.put(1)  # Tell our threads to terminate
 
     print('Waiting for all threads to terminate.')
@@ -0,0 +1,176 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# metrics.py - Prometheus metrics, shared between the HTTP workers through METRICS_DIR.
+
+
+from contextlib import suppress
+import glob
+import os
+import re
+from typing import Optional
+
+from ncconv.config import METRICS_DIR
+
+
+def _remove_dead_files(pattern: str):
+    '''
+    Deletes the files of processes that are no longer running, so that what they counted doesn't outlive them across restarts.
+    '''
+    for fn in glob.glob(os.path.join(METRICS_DIR, pattern)):
+        if not (m := re.search(r'_(\d+)\.db$', fn)):
+            continue
+
+        try:
+            os.kill(int(m.group(1)), 0)
+        except ProcessLookupError:
+            with suppress(OSError):
+                os.remove(fn)
+        except OSError:
+            pass  # running, but not ours
+
+
+# prometheus_client decides whether to share its values between processes when it is imported
+if METRICS_DIR:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_DIR
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _remove_dead_files('*.db')
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+
+# Conversions take anywhere from a second to a few minutes, probes and uploads a lot less
+__long_buckets = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+__short_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+JOB_WAIT = Histogram('ncconv_job_wait_seconds', 'Time from a job being enqueued to a worker starting on it',
+                     buckets=__long_buckets)
+PROBE_TIME = Histogram('ncconv_probe_seconds', 'Time taken by ffprobe to identify an input file',
+                       buckets=__short_buckets)
+ENCODE_TIME = Histogram('ncconv_encode_seconds', 'Time taken to convert a file to all of the formats a job asked for',
+                        buckets=__long_buckets)
+UPLOAD_TIME = Histogram('ncconv_upload_seconds', 'Time a conversion spent writing its output to GridFS, which overlaps with encoding',
+                        buckets=__short_buckets)
+WORKERS = Gauge('ncconv_workers', 'Workers by the jobs they take (convert or preview) and what they are doing',
+                ['pool', 'state'], multiprocess_mode='livesum')
+RATELIMIT_REJECTIONS = Counter('ncconv_ratelimit_rejections_total', 'Requests refused by a rate limit',
+                               ['key'])
+ADMISSION_REJECTIONS = Counter('ncconv_admission_rejections_total', 'Jobs refused because the queue of their worker pool was too long',
+                               ['pool'])
+DISK_READS = Counter('ncconv_disk_reads_total', 'Downloads by whether the file was on disk already, or was read from GridFS while it was copied there (filling) or not (miss)',
+                     ['result'])
+REAPER_SWEEP_TIME = Histogram('ncconv_reaper_sweep_seconds', 'Time taken by a sweep of the reaper',
+                              buckets=__short_buckets + (30, 60, 300))
+
+# queue document state -> label
+_queue_states = {0: 'queued', 1: 'converting', 2: 'done', 3: 'failed'}
+
+
+class _QueueDepth:
+    '''
+    Reports how many jobs are in each state, and how they are spread between clients, as counted right before
+    collecting. Clients aren't named, since /api/metrics may be public and they are identified by their address.
+    '''
+
+    def __init__(self, counts: dict, clients: int, busiest: Optional[dict]):
+        self.counts = counts
+        self.clients = clients
+        self.busiest = busiest
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            'ncconv_queue_jobs', 'Jobs in the queue by state', labels=['state'])
+
+        for state, label in _queue_states.items():
+            depth.add_metric([label], self.counts.get(state, 0))
+
+        yield depth
+
+        yield GaugeMetricFamily(
+            'ncconv_queue_clients', 'Clients with jobs waiting or converting', value=self.clients)
+
+        # how far a single client is ahead of the others, which is what fair queueing evens out
+        jobs = GaugeMetricFamily(
+            'ncconv_queue_busiest_client_jobs', 'Jobs waiting or converting of the client with the most, by state',
+            labels=['state'])
+        audio = GaugeMetricFamily(
+            'ncconv_queue_busiest_client_audio_seconds', 'Seconds of audio waiting or converting of the client with the most jobs')
+
+        busiest = self.busiest or {'queued': 0, 'converting': 0, 'duration': 0}
+        jobs.add_metric(['queued'], busiest['queued'])
+        jobs.add_metric(['converting'], busiest['converting'])
+        audio.add_metric([], busiest['duration'])
+
+        yield jobs
+        yield audio
+
+
+async def exposition(db) -> bytes:
+    '''
+    Returns the metrics of every process sharing METRICS_DIR (or of this one, without it), the queue depth and
+    how many clients are waiting in it, in the Prometheus text format.
+
+    :param db: Database reference (Motor)
+    '''
+    counts = {doc['_id']: doc['count'] async for doc in db.queue.aggregate([
+        {'$group': {'_id': '$state', 'count': {'$sum': 1}}}
+    ])}
+
+    # only the busiest client is reported, the others are only counted
+    spread = await db.queue.aggregate([
+        {'$match': {'state': {'$lte': 1}, 'preview': {'$ne': True}}},
+        {'$group': {
+            '_id': '$enqueued_by',
+            'queued': {'$sum': {'$cond': [{'$eq': ['$state', 0]}, 1, 0]}},
+            'converting': {'$sum': {'$cond': [{'$eq': ['$state', 1]}, 1, 0]}},
+            'duration': {'$sum': '$duration'}
+        }},
+        {'$facet': {
+            'clients': [{'$count': 'count'}],
+            'busiest': [{'$sort': {'queued': -1, 'duration': -1}}, {'$limit': 1}]
+        }}
+    ]).to_list(1)
+
+    clients = spread[0]['clients'][0]['count'] if spread and spread[0]['clients'] else 0
+    busiest = spread[0]['busiest'][0] if spread and spread[0]['busiest'] else None
+
+    return generate_latest(process_registry()) + generate_latest(_queue_registry(counts, clients, busiest))
+
+
+def _queue_registry(counts: dict, clients: int, busiest: Optional[dict]) -> CollectorRegistry:
+    registry = CollectorRegistry()
+    registry.register(_QueueDepth(counts, clients, busiest))
+
+    return registry
+
+
+def process_registry() -> CollectorRegistry:
+    '''
+    The registry that holds the metrics recorded by the processes of this instance.
+    '''
+    if not METRICS_DIR:
+        return REGISTRY
+
+    # Gauges of processes that died without resetting them would be added up forever otherwise
+    _remove_dead_files('gauge_live*.db')
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+
+    return registry
+
+
+def serve(port: int):
+    '''
+    Serves the metrics of the processes of this instance on a port of their own, in a thread.
+    Processes that don't run the HTTP server use this rather than prometheus_client, since METRICS_DIR has to be
+    seen by prometheus_client before anything imports it.
+    '''
+    start_http_server(port, registry=process_registry())
@@ -0,0 +1,114 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# queuepos.py - Works out positions in line, and how much work is ahead of a new
+# job, from a periodically refreshed snapshot of the queue, rather than counting
+# documents on every check or upload.
+
+
+import asyncio
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from itertools import accumulate
+from time import monotonic
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+
+
+# Sorts after every _id with the same sched_time
+_LAST_ID = ObjectId('f' * 24)
+
+
+def _claim_key(doc: dict) -> Tuple[datetime, ObjectId]:
+    '''
+    The order in which the workers claim jobs. Jobs from before sched_time existed go by submission time.
+
+    :param doc: Queue document with at least _id and sched_time
+    '''
+    return doc.get('sched_time') or doc['_id'].generation_time.replace(tzinfo=None), doc['_id']
+
+
+def job_work(doc: dict) -> float:
+    '''
+    How much work a conversion is, in the unit its service time is estimated in (see admission.py): seconds of
+    audio times output formats, of what it has left to do.
+    '''
+    return (doc.get('duration') or 0) * len(doc.get('output_formats') or [0]) * (1 - (doc.get('progress') or 0) / 100)
+
+
+class QueueSnapshot:
+    '''
+    The claim order of every job that is waiting or being converted, and how much work each is, refreshed at most
+    every interval seconds.
+
+    Must be created on the event loop that uses it.
+    '''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # conversions that are waiting or being converted, in claim order
+        self.keys: List[Tuple[datetime, ObjectId]] = []
+        # conversions that are waiting, in claim order, and the work of the first n of them at n
+        self.queued: List[Tuple[datetime, ObjectId]] = []
+        self.queued_work: List[float] = [0]
+        # conversions being converted, and their work
+        self.running = (0, 0.0)
+        # previews that are waiting or being converted
+        self.previews = 0
+        self.taken = None
+        self.lock = asyncio.Lock()
+
+    async def _refresh(self, db):
+        if self.taken is None or monotonic() - self.taken > self.interval:
+            async with self.lock:
+                # someone else may have refreshed it while we waited
+                if self.taken is None or monotonic() - self.taken > self.interval:
+                    cur = db.queue.find({'state': {'$lte': 1}}, {
+                                        'sched_time': 1, 'state': 1, 'preview': 1, 'duration': 1, 'output_formats': 1, 'progress': 1})
+                    docs = [d async for d in cur]
+                    conversions = [d for d in docs if not d.get('preview')]
+
+                    self.keys = sorted(_claim_key(d) for d in conversions)
+                    queued = sorted((_claim_key(d), job_work(d)) for d in conversions if d['state'] == 0)
+                    self.queued = [key for key, _ in queued]
+                    self.queued_work = list(accumulate((work for _, work in queued), initial=0))
+                    running = [job_work(d) for d in conversions if d['state'] == 1]
+                    self.running = (len(running), sum(running))
+                    self.previews = len(docs) - len(conversions)
+                    self.taken = monotonic()
+
+    async def position(self, db, doc: dict) -> int:
+        '''
+        Returns the position in line of a job. 1 means that nothing is ahead of it.
+
+        :param db: Database reference
+        :param doc: The job's queue document
+        '''
+        await self._refresh(db)
+
+        return bisect_left(self.keys, _claim_key(doc)) + 1
+
+    async def ahead(self, db, pool: str, before: Optional[datetime] = None) -> Tuple[int, float]:
+        '''
+        Returns how many jobs of a pool a new job would wait behind, and how much work they are. Previews are 1 each.
+
+        :param db: Database reference
+        :param pool: convert or preview
+        :param before: The new job's sched_time. Jobs queued after it don't hold it up, all of them do if None.
+                       Jobs that are being converted always do.
+        '''
+        await self._refresh(db)
+
+        if pool == 'preview':
+            return self.previews, self.previews
+
+        n = len(self.queued) if before is None else bisect_right(
+            self.queued, (before.astimezone(timezone.utc).replace(tzinfo=None), _LAST_ID))
+
+        return n + self.running[0], self.queued_work[n] + self.running[1]
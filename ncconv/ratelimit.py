@@ -9,11 +9,181 @@
 # ratelimit.py - Contains ratelimiting logic
 
 
+import asyncio
 from datetime import datetime, timedelta, timezone
 import math
-from typing import Callable
+from time import monotonic
+from typing import Callable, Dict, Optional, Tuple
 
 from fastapi import HTTPException, Request
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from ncconv.config import RATELIMIT_BACKEND, RATELIMIT_SYNC_INTERVAL
+from ncconv.metrics import RATELIMIT_REJECTIONS
+
+
+class RateLimiter:
+    '''
+    Interface for rate limiting backends.
+    '''
+
+    async def hit(self, db, ip: str, key: str, limit: int, unit_time: timedelta) -> Optional[float]:
+        '''
+        Counts a request against the limit. Returns None if it is allowed, or how many seconds to wait if it isn't.
+
+        :param db: Database reference
+        :param ip: The client
+        :param key: The rate limit group
+        :param limit: Limit per unit time
+        :param unit_time: Timedelta to apply this rate limit over
+        '''
+        raise NotImplementedError
+
+
+class MongoRateLimiter(RateLimiter):
+    '''
+    Generic cell rate algorithm with its state in MongoDB. Allows bursts of up to limit requests, refilled at a rate of
+    limit per unit_time. Each request is a single atomic update, so concurrent requests can't race each other.
+    '''
+
+    async def hit(self, db, ip: str, key: str, limit: int, unit_time: timedelta) -> Optional[float]:
+        now = datetime.now(timezone.utc)
+        # time between requests at the sustained rate, and how far ahead of it a client may get
+        interval = unit_time.total_seconds() * 1000 / limit
+        tolerance = unit_time.total_seconds() * 1000 - interval
+        # theoretical arrival time of the next request
+        tat = {'$max': ['$tat', now]}
+
+        pipeline = [
+            {'$set': {'allowed': {'$lte': [{'$subtract': [tat, now]}, tolerance]}}},
+            {'$set': {'tat': {'$cond': ['$allowed', {'$add': [tat, interval]}, '$tat']}}},
+            # once the bucket is full again, there is nothing left to remember
+            {'$set': {'bucket_expires': '$tat'}},
+            # left over from the old sliding window limiter
+            {'$unset': 'accesses'}
+        ]
+
+        try:
+            ratedata = await db.ratelimits.find_one_and_update({'ip': ip, 'key': key}, pipeline, upsert=True,
+                                                               return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # someone else created the document at the same time, try again now that it exists
+            ratedata = await db.ratelimits.find_one_and_update({'ip': ip, 'key': key}, pipeline,
+                                                               return_document=ReturnDocument.AFTER)
+
+        if ratedata['allowed']:
+            return None
+
+        # Motor does not seem to restore the timezone attributes for datetime objects, so we have to do this manually
+        return (ratedata['tat'].replace(tzinfo=timezone.utc) - now).total_seconds() - tolerance / 1000
+
+
+class _Bucket:
+    '''
+    Token bucket for one client and rate limit group
+    '''
+
+    def __init__(self, limit: int, unit_time: timedelta):
+        self.limit = limit
+        self.unit_time = unit_time
+        self.rate = limit / unit_time.total_seconds()  # tokens per second
+        self.tokens = float(limit)
+        self.updated = monotonic()
+        # tokens spent here since the last sync
+        self.unsynced = 0
+        # the shared count as of the last sync
+        self.seen = None
+
+    def refill(self, now: float):
+        self.tokens = min(self.limit, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class LocalRateLimiter(RateLimiter):
+    '''
+    Token buckets kept in memory, so that requests don't have to wait for MongoDB.
+
+    Every sync_interval seconds, the tokens spent in this process are added to a shared count in MongoDB in one batch,
+    and the tokens that other processes spent in the meantime are taken out of the local buckets. Limits are therefore
+    only enforced across processes up to one interval's worth of requests.
+    '''
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self.buckets: Dict[Tuple[str, str], _Bucket] = {}
+        self.synced = monotonic()
+        self.syncing = None
+
+    async def hit(self, db, ip: str, key: str, limit: int, unit_time: timedelta) -> Optional[float]:
+        now = monotonic()
+
+        if now - self.synced >= self.sync_interval and (not self.syncing or self.syncing.done()):
+            self.synced = now
+            self.syncing = asyncio.create_task(self._sync(db))
+
+        if not (bucket := self.buckets.get((ip, key))):
+            bucket = self.buckets[(ip, key)] = _Bucket(limit, unit_time)
+
+        bucket.refill(now)
+
+        if bucket.tokens < 1:
+            return (1 - bucket.tokens) / bucket.rate
+
+        bucket.tokens -= 1
+        bucket.unsynced += 1
+
+    async def _sync(self, db):
+        '''
+        Exchanges spent tokens with the other processes.
+        '''
+        try:
+            now, wall_now = monotonic(), datetime.now(timezone.utc)
+            buckets = {}
+
+            for (ip, key), bucket in list(self.buckets.items()):
+                bucket.refill(now)
+
+                # a full bucket that nobody here has touched can be forgotten
+                if not bucket.unsynced and bucket.tokens >= bucket.limit:
+                    del self.buckets[(ip, key)]
+                else:
+                    buckets[f'{key}:{ip}'] = bucket
+
+            if not buckets:
+                return
+
+            # remember what is being sent now, more may be spent while we wait
+            sent = {_id: bucket.unsynced for _id, bucket in buckets.items()}
+            for bucket in buckets.values():
+                bucket.unsynced = 0
+
+            await db.ratelimit_spent.bulk_write([
+                UpdateOne({'_id': _id}, {'$inc': {'spent': sent[_id]}, '$set': {
+                          'expires': wall_now + bucket.unit_time}}, upsert=True)
+                for _id, bucket in buckets.items()
+            ], ordered=False)
+
+            async for doc in db.ratelimit_spent.find({'_id': {'$in': list(buckets)}}):
+                bucket = buckets[doc['_id']]
+
+                # On the first sync, we can't tell what others spent recently from what they spent long ago
+                if bucket.seen is not None:
+                    # everything that was added since we last looked, except our own
+                    others = doc['spent'] - bucket.seen - sent[doc['_id']]
+
+                    # negative if the count expired and started over
+                    if others > 0:
+                        bucket.tokens -= others
+
+                bucket.seen = doc['spent']
+        except Exception as e:
+            print(e)
+
+
+_backend = LocalRateLimiter(
+    RATELIMIT_SYNC_INTERVAL) if RATELIMIT_BACKEND == 'local' else MongoRateLimiter()
 
 
 def ratelimit(key: str, limit: int, unit_time: timedelta) -> Callable:
@@ -27,42 +197,12 @@ def ratelimit(key: str, limit: int, unit_time: timedelta) -> Callable:
     :param unit_time: Timedelta to apply this rate limit over
     '''
     async def do_limit(request: Request):
-        ratedata = await request.app.state.db.ratelimits.find_one({'ip': request.client.host, 'key': key})
-
-        now = datetime.now(timezone.utc)
+        wait = await _backend.hit(request.app.state.db, request.client.host, key, limit, unit_time)
 
-        if ratedata is None:
-            ratedata = {
-                'ip': request.client.host,
-                'key': key,
-                'accesses': [
-                    now
-                ],
-                'bucket_expires': now + unit_time
-            }
-
-            await request.app.state.db.ratelimits.insert_one(ratedata)
-            return
-
-        new_accesses = []
-        for access in ratedata['accesses']:
-            # Motor does not seem to restore the timezone attributes for datetime objects, so we have to do this manually
-            access = access.replace(tzinfo=timezone.utc)
-
-            # append any accesses which still count against the rate limit
-            if now - access < unit_time:
-                new_accesses.append(access)
-
-        if limit <= len(new_accesses):
-            # ditto
-            exp = ratedata['bucket_expires'].replace(tzinfo=timezone.utc)
-
-            secs = f'{int(math.ceil((exp - now).total_seconds()))}'
+        if wait is not None:
+            RATELIMIT_REJECTIONS.labels(key).inc()
+            secs = f'{max(1, int(math.ceil(wait)))}'
             raise HTTPException(status_code=429, detail=f'You are being ratelimited. You can make requests again in {secs} seconds.', headers={
                                 'Retry-After': secs})
 
-        new_accesses.append(now)
-
-        await request.app.state.db.ratelimits.update_one({'ip': request.client.host, 'key': key}, {'$set': {'accesses': new_accesses, 'bucket_expires': now + unit_time}})
-
     return do_limit
@@ -10,90 +10,190 @@
 # freeing unused MongoDB objects in the background.
 
 
-from more_itertools import chunked
-from queue import Empty, Queue
+import asyncio
+from datetime import datetime, timedelta, timezone
+from queue import Empty, SimpleQueue
 from contextlib import suppress
+from time import monotonic
+from typing import List, Tuple
 
+from bson import ObjectId
 import sentry_sdk
 
 from ncconv.config import SENTRY_DSN
+from ncconv.diskstore import disk_store
+from ncconv.metrics import REAPER_SWEEP_TIME
+from ncconv.steps import Steps, batch, blocking, run_steps, run_steps_async
 
 
-# collection to aggregate on / delete from, pipeline
-__pipelines = [
-    (
-        'music.files',
-        [
-            {
-                '$lookup': {
-                    'from': 'queue',
-                    'localField': '_id',
-                    'foreignField': 'pending_file',
-                    'as': 'referenced_by'
-                }
-            }, {
-                '$match': {
-                    'referenced_by': {
-                        '$size': 0
-                    },
-                    'metadata.pending': True
-                }
-            }, {
-                '$project': {
-                    '_id': 1
-                }
-            }
-        ]
-    ),
-    (
-        'music.chunks',
-        [
-            {
-                '$lookup': {
-                    'from': 'music.files',
-                    'localField': 'files_id',
-                    'foreignField': '_id',
-                    'as': 'referenced_by'
-                }
-            }, {
-                '$match': {
-                    'referenced_by': {
-                        '$size': 0
-                    }
-                }
-            }, {
-                '$project': {
-                    '_id': 1
-                }
-            }
-        ]
-    )
-]
-
-
-def reaper_task(q: Queue, db):
+# How many files to delete with one query
+__batch_size = 500
+# Uploads are only stored as pending files for as long as it takes to insert their queue document
+__pending_grace = timedelta(minutes=10)
+# Chunks are written before their files document, so chunks of files that are still being written look orphaned
+__chunk_grace = timedelta(hours=1)
+# Looking for orphaned chunks has to look at every file, so it is done less often
+_orphan_sweep_interval = 3600
+# How often to sweep, in seconds
+__sweep_interval = 30
+
+
+def _free(db, ids: List[ObjectId]) -> Steps[int]:
+    '''
+    Deletes files along with all of their chunks. Returns how many chunks were freed.
+    '''
+    # chunks first, so that a failure can't leave chunks without a file
+    freed = (yield db['music.chunks'].delete_many(
+        {'files_id': {'$in': ids}})).deleted_count
+    yield db['music.files'].delete_many({'_id': {'$in': ids}})
+
+    return freed
+
+
+def _expired_files(db, now: datetime) -> Steps[Tuple[int, int]]:
+    '''
+    Reaps files that are past their expire_time. The TTL index would delete the files document but not its chunks.
+    Only files that expired since the last sweep are left to look at, so this is cheap.
+    '''
+    found = freed = 0
+
+    while (docs := (yield batch(db['music.files'].find({'metadata.expire_time': {'$lte': now}}, {'_id': 1}).limit(__batch_size), __batch_size))):
+        ids = [doc['_id'] for doc in docs]
+        found += len(ids)
+        freed += yield from _free(db, ids)
+
+        # They are never sent once expired, but would take up space until evicted
+        if (store := disk_store()):
+            yield blocking(store.remove, ids)
+
+    return found, freed
+
+
+def _abandoned_uploads(db, now: datetime) -> Steps[Tuple[int, int]]:
+    '''
+    Reaps pending files whose queue document is gone, because the client lost interest before they were converted.
+    '''
+    found = freed = 0
+    cur = db['music.files'].find({'metadata.pending': True, 'uploadDate': {
+                                 '$lt': now - __pending_grace}}, {'_id': 1})
+
+    while (docs := (yield batch(cur, __batch_size))):
+        ids = [doc['_id'] for doc in docs]
+        referenced = set((yield db.queue.distinct(
+            'pending_file', {'pending_file': {'$in': ids}})))
+
+        if (dead := [_id for _id in ids if _id not in referenced]):
+            found += len(dead)
+            freed += yield from _free(db, dead)
+
+    return found, freed
+
+
+def _orphaned_chunks(db, now: datetime) -> Steps[Tuple[int, int]]:
+    '''
+    Frees chunks whose files document is gone, e.g. because the TTL index got to it first or a worker died mid-upload.
+    Reads one index entry per file rather than looking at every chunk. The ids are grouped with a cursor, as distinct
+    would have to fit all of them into one 16MB document.
+    '''
+    horizon = ObjectId.from_datetime(now - __chunk_grace)
+    cur = db['music.chunks'].aggregate([
+        {'$match': {'files_id': {'$lt': horizon}}},
+        {'$group': {'_id': '$files_id'}}
+    ], allowDiskUse=True, batchSize=__batch_size)
+    found = freed = 0
+
+    while (docs := (yield batch(cur, __batch_size))):
+        ids = [doc['_id'] for doc in docs]
+        live = set((yield db['music.files'].distinct('_id', {'_id': {'$in': ids}})))
+
+        if (dead := [_id for _id in ids if _id not in live]):
+            found += len(dead)
+            freed += (yield db['music.chunks'].delete_many(
+                {'files_id': {'$in': dead}})).deleted_count
+
+    return found, freed
+
+
+class Reaper:
+    '''
+    Frees expired files and orphaned gridfs chunks, and records what it did in stats.reaper
+    '''
+
+    def __init__(self):
+        self.last_orphan_sweep = None
+
+    def sweep(self, db) -> Steps[None]:
+        '''
+        Sweeps once. A step generator (see steps.py).
+        '''
+        started, now = monotonic(), datetime.now(timezone.utc)
+        sweeps = [_expired_files, _abandoned_uploads]
+
+        if self.last_orphan_sweep is None or started - self.last_orphan_sweep >= _orphan_sweep_interval:
+            sweeps.append(_orphaned_chunks)
+            self.last_orphan_sweep = started
+
+        found = freed = 0
+        for sweep in sweeps:
+            f, r = yield from sweep(db, now)
+            found, freed = found + f, freed + r
+
+        took = monotonic() - started
+        REAPER_SWEEP_TIME.observe(took)
+        yield db.stats.update_one({'_id': 'reaper'}, {
+            '$set': {'last_sweep': now, 'last_duration': took, 'last_found': found, 'last_freed': freed},
+            '$inc': {'sweeps': 1, 'found': found, 'freed': freed}
+        }, upsert=True)
+
+        if found:
+            print(
+                f'reaper: found {found} dead files, freed {freed} chunks in {took:.2f}s')
+
+
+def _report(e: Exception):
+    if SENTRY_DSN:
+        sentry_sdk.capture_exception(e)
+
+    print(e)
+
+
+def reaper_task(q: SimpleQueue, db):
     '''
-    Thread periodically frees orphaned gridfs chunks when the parent is killed by the database
+    Thread sweeps every now and then, until it is sent anything but None on q.
+
+    :param q: Termination signal queue
+    :param db: Database reference (pymongo)
     '''
+    reaper = Reaper()
 
     while True:
         try:
             with suppress(Empty):
-                poison = q.get(block=True, timeout=30)
+                poison = q.get(block=True, timeout=__sweep_interval)
                 if poison:
                     break
 
-            # Fetch a cursor of documents to delete
-            for collection, pipeline in __pipelines:
-                cur = db[collection].aggregate(pipeline)
+            run_steps(reaper.sweep(db))
+        except Exception as e:
+            _report(e)
 
-                for docs in chunked(cur, 50):
-                    db[collection].delete_many({
-                        '$or': [{'_id': doc['_id']} for doc in docs]
-                    })
 
-        except Exception as e:
-            if SENTRY_DSN:
-                sentry_sdk.capture_exception(e)
+async def reap(db, stop: asyncio.Event):
+    '''
+    Same as reaper_task, on the event loop, until stop is set.
 
-            print(e)
+    :param db: Database reference (Motor)
+    '''
+    reaper = Reaper()
+
+    while True:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), __sweep_interval)
+
+        if stop.is_set():
+            break
+
+        try:
+            await run_steps_async(reaper.sweep(db))
+        except Exception as e:
+            _report(e)
@@ -0,0 +1,91 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# recents.py - Keeps the list of recently converted files in memory, so that
+# the home page doesn't have to query music.files on every visit.
+
+
+import asyncio
+from datetime import datetime, timezone
+from time import monotonic
+from typing import List, Optional
+
+from ncconv.steps import Steps
+
+
+# How many files are listed
+RECENTS_COUNT = 10
+
+
+def artifact_inserted(db) -> Steps[None]:
+    '''
+    Tells every Recents that a new artifact exists. Called by the workers after storing a conversion. A step generator.
+
+    :param db: Database reference
+    '''
+    yield db.stats.update_one({'_id': 'artifacts'}, {'$inc': {'inserted': 1}}, upsert=True)
+
+
+class Recents:
+    '''
+    The most recently converted files.
+
+    Whether anything was converted since the last refresh is checked at most every check_interval seconds, which is
+    a single lookup by _id. The list itself is only queried again when something was, when one of the files in it has
+    expired, or after max_age seconds, whichever comes first.
+
+    Must be created on the event loop that uses it.
+    '''
+
+    def __init__(self, check_interval: float, max_age: float):
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.ids: List[str] = []
+        # value of stats.artifacts.inserted when ids was queried
+        self.generation = None
+        self.checked = self.refreshed = None
+        # when the first file in ids expires
+        self.expires: Optional[datetime] = None
+        self.lock = asyncio.Lock()
+
+    async def get(self, db) -> List[str]:
+        '''
+        Returns the ids of the most recently converted files, newest first.
+
+        :param db: Database reference
+        '''
+
+        if self.checked is None or monotonic() - self.checked >= self.check_interval:
+            async with self.lock:
+                # someone else may have checked while we waited
+                if self.checked is None or monotonic() - self.checked >= self.check_interval:
+                    await self._check(db)
+
+        return self.ids
+
+    async def _check(self, db):
+        stats = await db.stats.find_one({'_id': 'artifacts'}, {'inserted': 1})
+        # read before the query, so that anything inserted while it runs is picked up by the next check
+        generation = stats['inserted'] if stats else 0
+        now = monotonic()
+
+        if generation != self.generation or now - self.refreshed >= self.max_age or \
+                (self.expires and datetime.now(timezone.utc) >= self.expires):
+            # uses the metadata.pending, uploadDate index
+            cur = db.music.files.find({'metadata.pending': {'$in': [None, False]}, 'metadata.preview': {'$ne': True}}, {'metadata.expire_time': 1},
+                                      sort=[('uploadDate', -1)], limit=RECENTS_COUNT)
+
+            docs = [doc async for doc in cur]
+
+            self.ids = [str(doc['_id']) for doc in docs]
+            # Motor does not restore the timezone attributes for datetime objects
+            self.expires = min((doc['metadata']['expire_time'].replace(tzinfo=timezone.utc)
+                               for doc in docs if 'expire_time' in doc.get('metadata', {})), default=None)
+            self.generation, self.refreshed = generation, now
+
+        self.checked = now
@@ -9,72 +9,206 @@
 # convert.py - Routes related to enqueueing conversion tasks and monitoring thereof.
 
 
+import asyncio
+from contextlib import suppress
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from hashlib import sha256
+from typing import Callable, List, Optional, Tuple
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, Request
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from orjson import dumps as json_dumps
 from pydantic import BaseModel, confloat, constr
 from bson import ObjectId
 from bson.errors import InvalidId
+from gridfs.errors import NoFile
 
-from ncconv.config import DEFAULT_TEMPO, DEFAULT_PITCH
+from ncconv.admission import admit
+from ncconv.config import ADMISSION_MAX_WAIT, DEFAULT_TEMPO, DEFAULT_PITCH, MAX_UPLOAD_SIZE, PREVIEW_SECONDS, PROBE_SIZE, TASK_EVENTS_INTERVAL
+from ncconv.fairqueue import peek_sched_time, sched_time
+from ncconv.ffconv import ProbeResult, probe_audio, sniff_audio
 from ncconv.ratelimit import ratelimit
 
 convert_router = APIRouter(
     prefix='/convert', default_response_class=ORJSONResponse)
 
 
+# Uploads are read and stored this much at a time. Larger than the GridFS default, so that storing them takes fewer inserts.
+_UPLOAD_CHUNK = 1024 * 1024
+
+
+async def _store_upload(request: Request, audio_file: UploadFile, expire_time: datetime,
+                        needed: Optional[Callable[[ProbeResult], int]] = None) -> Tuple[ObjectId, str, ProbeResult, int]:
+    '''
+    Stores an upload as a pending file, checking its size and format on the way. Returns the id of the pending file,
+    the hash of what was stored (which lets the workers find earlier conversions of the same file), what ffprobe had
+    to say about it and how many bytes were stored.
+
+    :param audio_file: The upload
+    :param expire_time: When the pending file may be deleted
+    :param needed: Given what ffprobe had to say, how much of the file is worth storing. All of it if None.
+    '''
+    digest = sha256()
+
+    # Anything that obviously isn't audio is refused before it is stored
+    r = await audio_file.read(_UPLOAD_CHUNK)
+    if not sniff_audio(r):
+        raise HTTPException(status_code=400, detail='Unsupported input format')
+
+    # The start of the file is probed while the rest of it is stored
+    prefix = bytearray()
+    probe = None
+    size = 0
+
+    async with request.app.state.file_store.open_upload_stream(audio_file.filename, chunk_size_bytes=_UPLOAD_CHUNK, metadata={
+        'pending': True,
+        'expire_time': expire_time
+    }) as grid_in:
+        try:
+            while r:
+                digest.update(r)
+                size += len(r)
+
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(
+                        status_code=413, detail='Your file is too large.')
+
+                if probe is None:
+                    prefix += r
+                    if len(prefix) >= PROBE_SIZE:
+                        probe = asyncio.create_task(
+                            probe_audio(bytes(prefix[:PROBE_SIZE])))
+                elif probe.done():
+                    probe.result()  # raises if unsupported, so we don't store the rest of it
+
+                await grid_in.write(r)
+
+                if needed and probe and probe.done() and size >= needed(probe.result()):
+                    break
+
+                r = await audio_file.read(_UPLOAD_CHUNK)
+
+            probed = await (probe or probe_audio(bytes(prefix)))
+        except BaseException:
+            if probe:
+                probe.cancel()
+
+            await grid_in.abort()
+            raise
+
+    return grid_in._id, digest.hexdigest(), probed, size
+
+
 class EnqueueResponse(BaseModel):
     task_id: str
+    estimated_wait: Optional[float]  # seconds until a worker starts on it, if that can be told
 
 
 @convert_router.post('/', response_model=EnqueueResponse, status_code=202, dependencies=[Depends(ratelimit('do_conversion', 5, timedelta(minutes=5)))])
 async def convert_audio_file(request: Request, audio_file: UploadFile = File(...),
-                             output_format: constr(
-                                 regex='ogg|m4a') = Form(...),
+                             output_format: List[constr(
+                                 regex='ogg|m4a')] = Form(...),
                              scale_pitch: confloat(
                                  gt=0, le=10) = Form(DEFAULT_PITCH),
                              scale_tempo: confloat(gt=0, le=10) = Form(DEFAULT_TEMPO)) -> EnqueueResponse:
     '''
     enqueues the audio file to the user's specification and returns a key that be used with /check
 
-    Warning: Length is not checked. Must enforce in NGINX
+    Uploads larger than MAX_UPLOAD_SIZE are refused with 413, and ones that don't look like audio with 400.
+    Neither leaves anything behind in GridFS. If the job would wait for longer than ADMISSION_MAX_WAIT, it is refused
+    with 503 and Retry-After before anything is stored.
 
     :param audio_file: The audio file to process
-    :param output_format: The desired output format
+    :param output_format: The desired output format. May be given more than once to get the file in several formats.
     :param scale_pitch: pitch scale factor
     :param scale_tempo: tempo scale factor
     '''
 
     now = datetime.now(timezone.utc)
     deadline = now + timedelta(days=1)
+    # in the order they were asked for, but only once each
+    output_formats = list(dict.fromkeys(output_format))
+    client = str(request.client.host)
+    db = request.app.state.db
 
-    async with request.app.state.file_store.open_upload_stream(audio_file.filename, metadata={
-        'pending': True,
-        'expire_time': deadline
-    }) as grid_in:
-        while (r := await audio_file.read(250 * 1024)):
-            await grid_in.write(r)
+    # Its length isn't known until the upload is probed, so it is let in as if it were as short as can be.
+    # That is close enough to where it is lined up to tell the client how long it will wait as well.
+    wait = await admit(db, request.app.state.queue_snapshot, 'convert', ADMISSION_MAX_WAIT,
+                       await peek_sched_time(db, client, now, 0, len(output_formats)))
 
-    task_id = await request.app.state.db.queue.insert_one({
-        'pending_file': grid_in._id,
+    pending_file, input_hash, probed, size = await _store_upload(request, audio_file, deadline)
+    duration = probed.estimate_duration(size)
+    scheduled = await sched_time(db, client, now, duration, len(output_formats))
+
+    task_id = await db.queue.insert_one({
+        'pending_file': pending_file,
+        'input_hash': input_hash,
+        'input_format': probed.format,
+        'sample_rate': probed.sample_rate,
+        'duration': duration,
+        # Shortest job first, and fair between clients: later and longer tracks are claimed as if they had been
+        # enqueued a little later, so they can be overtaken by short ones for a while, but never indefinitely
+        'sched_time': scheduled,
         'scale_pitch': scale_pitch,
         'scale_tempo': scale_tempo,
-        'output_format': output_format,
+        'output_format': output_formats[0],
+        'output_formats': output_formats,
         'expire_time': deadline,
         'last_checked': now,
-        'enqueued_by': str(request.client.host),
+        'enqueued_by': client,
         'state': 0
     })
 
-    return EnqueueResponse(task_id=str(task_id.inserted_id))
+    return EnqueueResponse(task_id=str(task_id.inserted_id), estimated_wait=wait)
 
 
 class CheckResponse(BaseModel):
     complete: bool
     position: Optional[int]  # if not completed
+    progress: Optional[float]  # percent, if being converted
     file_id: Optional[str]  # if completed
+    file_ids: Optional[List[str]]  # if completed, one per requested format
+
+
+def _parse_task_id(task_id: str) -> ObjectId:
+    try:
+        return ObjectId(task_id)
+    except InvalidId as e:
+        raise HTTPException(status_code=400, detail='Bad object ID') from e
+
+
+async def _touch_task(request: Request, task_id: ObjectId) -> dict:
+    '''
+    Fetches a task and marks it as checked, so that it isn't garbage collected.
+    '''
+    doc = await request.app.state.db.queue.find_one_and_update({'_id': task_id}, {'$set': {'last_checked': datetime.now(timezone.utc)}})
+    if not doc:
+        raise HTTPException(status_code=404, detail='No such task was found.')
+
+    return doc
+
+
+async def _task_status(request: Request, doc: dict) -> CheckResponse:
+    '''
+    Works out what to tell the client about a task. Finished tasks are deleted, failed tasks raise their error.
+
+    :param doc: The task's queue document
+    '''
+    if doc['state'] == 2:
+        await request.app.state.db.queue.delete_one({'_id': doc['_id']})
+        return CheckResponse(complete=True, file_id=str(doc['completed_file']),
+                             file_ids=[str(file_id) for file_id in doc.get('completed_files', [doc['completed_file']])])
+    elif doc['state'] == 3:
+        await request.app.state.db.queue.delete_one({'_id': doc['_id']})
+        raise HTTPException(
+            status_code=doc['status_code'], detail=doc['detail'])
+    elif doc['state'] > 3:
+        raise HTTPException(
+            status_code=500, detail='Request is in a bad state. Try making a new one!')
+
+    # Clients check constantly, so this comes from a snapshot of the queue rather than a count
+    position = await request.app.state.queue_snapshot.position(request.app.state.db, doc)
+    return CheckResponse(complete=False, position=position, progress=doc.get('progress'))
 
 
 @convert_router.get('/check', response_model=CheckResponse, response_model_exclude_none=True, response_model_exclude_unset=True, dependencies=[Depends(ratelimit('check_status', 5, timedelta(seconds=5)))])
@@ -88,27 +222,234 @@ async def check(request: Request, task_id: str):
 
     :param task_id: The task to check
     '''
+    doc = await _touch_task(request, _parse_task_id(task_id))
+    return await _task_status(request, doc)
+
+
+def _event(name: str, data: dict) -> bytes:
+    return b'event: ' + name.encode() + b'\ndata: ' + json_dumps(data) + b'\n\n'
+
+
+@convert_router.get('/events/{task_id}', dependencies=[Depends(ratelimit('task_events', 5, timedelta(minutes=1)))])
+async def events(request: Request, task_id: str) -> StreamingResponse:
+    '''
+    Same as /check, but as a stream of server-sent events, so that the client doesn't have to poll.
+
+    A "status" event with the fields of CheckResponse is sent whenever something changes. The stream ends after
+    the status event for a completed task, or after a "failed" event with status_code and detail.
+
+    The task is kept alive for as long as the stream is open.
+
+    :param task_id: The task to follow
+    '''
+    task_id = _parse_task_id(task_id)
+    # errors before the stream starts are reported like everywhere else
+    doc = await _touch_task(request, task_id)
+
+    async def stream(doc: dict):
+        last, quiet = None, 0
+
+        while not await request.is_disconnected():
+            try:
+                status = await _task_status(request, doc)
+            except HTTPException as e:
+                yield _event('failed', {'status_code': e.status_code, 'detail': e.detail})
+                return
+
+            if status != last:
+                yield _event('status', status.dict(exclude_none=True))
+                last, quiet = status, 0
+            elif (quiet := quiet + 1) * TASK_EVENTS_INTERVAL >= 15:
+                # keeps proxies from closing the connection
+                yield b': keepalive\n\n'
+                quiet = 0
+
+            if status.complete:
+                return
+
+            await asyncio.sleep(TASK_EVENTS_INTERVAL)
+
+            try:
+                doc = await _touch_task(request, task_id)
+            except HTTPException as e:
+                yield _event('failed', {'status_code': e.status_code, 'detail': e.detail})
+                return
+
+    return StreamingResponse(stream(doc), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # nginx
+    })
+
+
+# How soon a preview that is being streamed looks for more of it, in seconds. It waits twice as long every time it
+# finds nothing, up to _PREVIEW_MAX_POLL, so that a slow one isn't polled 20 times a second.
+_PREVIEW_POLL = 0.05
+_PREVIEW_MAX_POLL = 1
+# A preview that hasn't started after this many seconds isn't going to be a quick one
+_PREVIEW_TIMEOUT = 20
+# How often a preview that is being streamed is marked as checked, in seconds. Well under the TTL on last_checked.
+_PREVIEW_TOUCH = 10
+
+
+async def _preview_chunk(db, task_id: ObjectId, file_id: ObjectId, n: int) -> Optional[bytes]:
+    '''
+    Waits for chunk n of a preview that is being converted. Returns None once the preview is complete and has no more
+    chunks. Raises the error of a failed preview. The preview is marked as checked while it waits.
+
+    :param task_id: The preview's queue document
+    :param file_id: The GridFS file it is converted into
+    :param n: Which chunk
+    '''
+    loop = asyncio.get_running_loop()
+    started, delay = loop.time(), _PREVIEW_POLL
+
+    while not (chunk := await db.music.chunks.find_one({'files_id': file_id, 'n': n})):
+        doc = await db.queue.find_one_and_update({'_id': task_id}, {'$set': {'last_checked': datetime.now(timezone.utc)}},
+                                                 {'state': 1, 'status_code': 1, 'detail': 1})
+
+        if not doc:
+            raise HTTPException(
+                status_code=500, detail='Your preview went missing. Try again!')
+        elif doc['state'] == 2:
+            # the last chunk was written before the job was marked as done
+            chunk = await db.music.chunks.find_one({'files_id': file_id, 'n': n})
+            return chunk['data'] if chunk else None
+        elif doc['state'] == 3:
+            raise HTTPException(
+                status_code=doc['status_code'], detail=doc['detail'])
+        elif loop.time() - started > _PREVIEW_TIMEOUT:
+            raise HTTPException(
+                status_code=503, detail='Previews are busy right now. Try again later!')
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, _PREVIEW_MAX_POLL)
+
+    return chunk['data']
+
+
+async def _cancel_preview(request: Request, task_id: ObjectId, file_id: ObjectId):
+    '''
+    Deletes a preview that is no longer streamed. One that a worker is still converting is only marked as cancelled,
+    since the worker would go on writing chunks into a deleted file. It deletes the preview itself once it stops.
+    '''
+    db = request.app.state.db
+
+    # the worker may finish it between the two, which one of them notices
+    for _ in range(2):
+        if (await db.queue.delete_one({'_id': task_id, 'state': {'$ne': 1}})).deleted_count:
+            # the reaper gets to it once it expires otherwise
+            with suppress(NoFile):
+                await request.app.state.file_store.delete(file_id)
+            return
+
+        if (await db.queue.update_one({'_id': task_id, 'state': 1}, {'$set': {'cancelled': True}})).matched_count:
+            return
+
+
+@convert_router.post('/preview', response_model=EnqueueResponse, response_model_exclude_none=True,
+                     dependencies=[Depends(ratelimit('preview', 30, timedelta(minutes=1)))])
+async def preview(request: Request, audio_file: UploadFile = File(...),
+                  output_format: constr(regex='ogg|m4a') = Form('ogg'),
+                  scale_pitch: confloat(gt=0, le=10) = Form(DEFAULT_PITCH),
+                  scale_tempo: confloat(gt=0, le=10) = Form(DEFAULT_TEMPO)) -> EnqueueResponse:
+    '''
+    Starts converting the first PREVIEW_SECONDS of the audio file at a low bitrate, and returns a key that can be used
+    with GET /preview/{task_id} once the start of it is ready. Previews are converted by workers of their own, so they
+    don't wait behind full conversions, and only as much of the upload as the preview needs is stored. If the preview
+    workers are too busy for it to start in time, it is refused with 503 and Retry-After before anything is stored.
+
+    :param audio_file: The audio file to preview
+    :param output_format: The desired output format
+    :param scale_pitch: pitch scale factor
+    :param scale_tempo: tempo scale factor
+    '''
+    db = request.app.state.db
+    now = datetime.now(timezone.utc)
+    deadline = now + timedelta(minutes=10)
+
+    # It would only time out waiting for its first chunk
+    await admit(db, request.app.state.queue_snapshot, 'preview', _PREVIEW_TIMEOUT)
+
+    def needed(probed: ProbeResult) -> int:
+        # The preview plays the input back scale_tempo * scale_pitch times faster. Anything ahead of the audio
+        # (such as cover art) fits in what was probed. Without a bit rate, assume it is as large as a CD's.
+        return PROBE_SIZE + int((probed.bit_rate or 1411200) / 8 * PREVIEW_SECONDS * scale_tempo * scale_pitch)
+
+    pending_file, _, probed, _ = await _store_upload(request, audio_file, deadline, needed)
+    file_id = ObjectId()
+
+    task_id = (await db.queue.insert_one({
+        'preview': True,
+        'pending_file': pending_file,
+        'preview_file': file_id,
+        'input_format': probed.format,
+        'sample_rate': probed.sample_rate,
+        'sched_time': now,
+        'scale_pitch': scale_pitch,
+        'scale_tempo': scale_tempo,
+        'output_format': output_format,
+        'expire_time': deadline,
+        'last_checked': now,
+        'enqueued_by': str(request.client.host),
+        'state': 0
+    })).inserted_id
+
+    # Errors are reported here, where the client can read them, rather than to whatever plays the stream
     try:
-        task_id = ObjectId(task_id)
-    except InvalidId as e:
-        raise HTTPException(status_code=400, detail='Bad object ID') from e
+        await _preview_chunk(db, task_id, file_id, 0)
+    except BaseException:
+        await _cancel_preview(request, task_id, file_id)
+        raise
 
-    doc = await request.app.state.db.queue.find_one_and_update({'_id': task_id}, {'$set': {'last_checked': datetime.now(timezone.utc)}})
+    return EnqueueResponse(task_id=str(task_id))
+
+
+@convert_router.get('/preview/{task_id}', dependencies=[Depends(ratelimit('preview_stream', 30, timedelta(minutes=1)))])
+async def preview_stream(request: Request, task_id: str) -> StreamingResponse:
+    '''
+    Streams a preview back while it is being converted, so that it can be played as it comes in, e.g. by pointing an
+    audio element at this. The preview is deleted once it has been streamed, or cancelled if the client goes away first.
+
+    :param task_id: The preview to stream, from POST /preview
+    '''
+    task_id = _parse_task_id(task_id)
+    db = request.app.state.db
+
+    doc = await db.queue.find_one_and_update({'_id': task_id, 'preview': True}, {'$set': {'last_checked': datetime.now(timezone.utc)}},
+                                             {'preview_file': 1, 'output_format': 1})
     if not doc:
         raise HTTPException(status_code=404, detail='No such task was found.')
 
-    if doc['state'] == 2:
-        await request.app.state.db.queue.delete_one({'_id': task_id})
-        return CheckResponse(complete=True, file_id=str(doc['completed_file']))
-    elif doc['state'] == 3:
-        await request.app.state.db.queue.delete_one({'_id': task_id})
-        raise HTTPException(
-            status_code=doc['status_code'], detail=doc['detail'])
-    elif doc['state'] > 3:
-        raise HTTPException(
-            status_code=500, detail='Request is in a bad state. Try making a new one!')
+    file_id = doc['preview_file']
+
+    # errors before the stream starts are reported like everywhere else
+    try:
+        first = await _preview_chunk(db, task_id, file_id, 0)
+    except BaseException:
+        await _cancel_preview(request, task_id, file_id)
+        raise
+
+    async def stream(chunk: Optional[bytes]):
+        loop = asyncio.get_running_loop()
+        n, touched = 0, loop.time()
 
-    # _id encodes a 4 byte timestamp, so it can be used to roughly guess how many documents are ahead of us
-    # anything with an _id less the doc['_id'] would have be submitted before us
-    ahead = (await request.app.state.db.queue.count_documents({'_id': {'$lt': doc['_id']}, 'state': {'$lte': 1}}))
-    return CheckResponse(complete=False, position=ahead + 1)
+        try:
+            while chunk:
+                yield chunk
+                n += 1
+
+                # the chunks may come in faster than _preview_chunk looks at the job
+                if loop.time() - touched >= _PREVIEW_TOUCH:
+                    touched = loop.time()
+                    await db.queue.update_one({'_id': task_id}, {'$set': {'last_checked': datetime.now(timezone.utc)}})
+
+                chunk = await _preview_chunk(db, task_id, file_id, n)
+        except HTTPException:
+            pass  # too late to tell the client, the preview just ends early
+        finally:
+            await _cancel_preview(request, task_id, file_id)
+
+    return StreamingResponse(stream(first), media_type='audio/mp4' if doc['output_format'] == 'm4a' else 'audio/ogg', headers={
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'  # nginx
+    })
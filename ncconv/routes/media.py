@@ -11,22 +11,106 @@
 
 
 from datetime import datetime
-from typing import List
+import re
+from typing import BinaryIO, List, Optional, Tuple
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from starlette.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
 from bson import ObjectId
 from bson.errors import InvalidId
-from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridOut
 
 media_router = APIRouter(prefix='/media')
 
 
-@media_router.get('/file/{file_id}/{filename}')
-async def get_file(ctx: Request, file_id: str, filename: str) -> StreamingResponse:
+def _etag(file_id: ObjectId) -> str:
     '''
-    Retrieves a file from GridFS with the specified file_id.
+    Artifacts never change once written, so their id is as good an entity tag as any
+    '''
+    return f'"{file_id}"'
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    '''
+    Checks an If-None-Match or If-Range header against an entity tag. Weak tags match too.
+    '''
+    if not header:
+        return False
+
+    return any(tag.strip() in ('*', etag, f'W/{etag}') for tag in header.split(','))
+
+
+def _parse_range(header: Optional[str], length: int) -> Optional[Tuple[int, int]]:
+    '''
+    Parses a Range header into the first and last byte to send. Returns None if the whole file should be sent,
+    which is what we do for malformed headers and requests for more than one range.
+
+    Raises a 416 if the range lies outside of the file.
+
+    :param header: Value of the Range header
+    :param length: Length of the file
+    '''
+    if not header or not (m := re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)) or m.group(1) == m.group(2) == '':
+        return None
+
+    first, last = m.groups()
+
+    if first == '':
+        # suffix range, the last n bytes
+        first, last = max(0, length - int(last)), length - 1
+    else:
+        first, last = int(first), min(int(last), length - 1) if last else length - 1
+
+    if first > last or first >= length:
+        raise HTTPException(status_code=416, detail='Requested range not satisfiable',
+                            headers={'Content-Range': f'bytes */{length}'})
+
+    return first, last
+
+
+class _FileRangeResponse(Response):
+    '''
+    Sends part of an open file. Starlette's FileResponse can't send a range, and reads 4 KiB at a time.
+
+    If the server supports it, the file is handed to the server to send (zero copy) instead of being read here.
+    '''
+    chunk_size = 256 * 1024
+
+    def __init__(self, file: BinaryIO, first: int, last: int, status_code: int, media_type: str, headers: dict):
+        super().__init__(status_code=status_code, media_type=media_type, headers=headers)
+        self.file, self.first, self.last = file, first, last
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': self.file,
+                            'offset': self.first, 'count': self.last - self.first + 1})
+                return
+
+            await run_in_threadpool(self.file.seek, self.first)
+            remaining = self.last - self.first + 1
+
+            while remaining > 0 and (chunk := await run_in_threadpool(self.file.read, min(remaining, self.chunk_size))):
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            self.file.close()
+
+
+@media_router.api_route('/file/{file_id}/{filename}', methods=['GET', 'HEAD'])
+async def get_file(ctx: Request, file_id: str, filename: str) -> Response:
+    '''
+    Retrieves a file from GridFS with the specified file_id, or from its copy on disk if ARTIFACT_DISK_DIR is set.
+
+    Supports HEAD, single byte ranges (so that players can seek without downloading everything before that point)
+    and conditional requests through the ETag.
 
     :param file_id: ObjectID represented as a string
     :param filename: Potentially necessary to play and download
@@ -39,27 +123,62 @@ async def get_file(ctx: Request, file_id: str, filename: str) -> StreamingRespon
         raise HTTPException(
             status_code=400, detail='Audio file ID is not valid') from e
 
-    try:
-        grid_out = await ctx.app.state.file_store.open_download_stream(file_id)
-    except NoFile as e:
-        raise HTTPException(
-            status_code=404, detail='Audio file expired or never existed.') from e
+    fi = await ctx.app.state.artifact_cache.get(ctx.app.state.db, file_id)
 
-    if 'pending' in grid_out.metadata:
+    if not fi:
         raise HTTPException(
             status_code=404, detail='Audio file expired or never existed.')
 
-    content_type = grid_out.metadata['content_type']
+    etag = _etag(file_id)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'public, max-age=31536000, immutable, no-transform',
+        'ETag': etag
+    }
+
+    if _etag_matches(ctx.headers.get('If-None-Match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    headers['Content-Disposition'] = f'attachment; filename="{fi["filename"]}"'
+    length = fi['length']
+
+    # If-Range asks for the whole file if it has changed since the part the client has was sent
+    if_range = ctx.headers.get('If-Range')
+    byte_range = _parse_range(ctx.headers.get('Range'), length) if not if_range or _etag_matches(
+        if_range, etag) else None
+
+    if byte_range:
+        first, last = byte_range
+        status_code = 206
+        headers['Content-Range'] = f'bytes {first}-{last}/{length}'
+    else:
+        first, last = 0, length - 1
+        status_code = 200
+
+    headers['Content-Length'] = str(last - first + 1)
+
+    if ctx.method == 'HEAD':
+        return Response(status_code=status_code, media_type=fi['metadata']['content_type'], headers=headers)
+
+    def grid_out():
+        # The files document is already known, so this doesn't look it up again
+        return AsyncIOMotorGridOut(ctx.app.state.db.music, file_document=fi)
+
+    # Sent from the copy on disk if there is one. Otherwise, one is made in the background while this is read from GridFS
+    if (store := ctx.app.state.disk_store) and (f := await store.open_or_fill(fi, grid_out)):
+        return _FileRangeResponse(f, first, last, status_code, fi['metadata']['content_type'], headers)
 
     async def reader():
-        while grid_out.tell() < grid_out.length:
-            yield await grid_out.readchunk()
+        f = grid_out()
+        # seeking only moves the position, the next readchunk fetches the chunk it lies in
+        f.seek(first)
+        remaining = last - first + 1
 
-    return StreamingResponse(reader(), media_type=content_type, headers={
-        'Content-Disposition': f'attachment; filename="{grid_out.filename}"',
-        'Cache-Control': 'public, max-age=31536000, immutable, no-transform',
-        'Content-Length': str(grid_out.length)
-    })
+        while remaining > 0 and (chunk := await f.readchunk()):
+            yield chunk[:remaining]
+            remaining -= len(chunk)
+
+    return StreamingResponse(reader(), status_code=status_code, media_type=fi['metadata']['content_type'], headers=headers)
 
 
 class FileDescription(BaseModel):
@@ -70,7 +189,7 @@ class FileDescription(BaseModel):
 
 
 @media_router.get('/describe/{file_id}', response_class=ORJSONResponse)
-async def get_file(ctx: Request, file_id: str) -> FileDescription:
+async def get_file(ctx: Request, response: Response, file_id: str) -> FileDescription:
     '''
     Retrieves basic infomration about a GridFS object. Is needed by the front end to actually stream the object.
 
@@ -82,29 +201,30 @@ async def get_file(ctx: Request, file_id: str) -> FileDescription:
         raise HTTPException(
             status_code=400, detail='Audio file ID is not valid') from e
 
-    fi = await ctx.app.state.db.music.files.find_one({'_id': file_id, '$or': [{'metadata.pending': {'$exists': False}}, {'metadata.pending': False}]})
+    fi = await ctx.app.state.artifact_cache.get(ctx.app.state.db, file_id)
 
     if not fi:
         raise HTTPException(
             status_code=404, detail='Audio file expired or never existed.')
 
+    # The expiry may be pushed back when the same conversion is requested again
+    etag = f'"{file_id}-{int(fi["metadata"]["expire_time"].timestamp())}"'
+
+    if _etag_matches(ctx.headers.get('If-None-Match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    response.headers['ETag'] = etag
+
     return FileDescription(filename=fi['filename'], content_type=fi['metadata']['content_type'], expire_time=fi['metadata']['expire_time'], length=fi['length'])
 
 
 @media_router.get('/recents', response_class=ORJSONResponse)
-async def get_recents(ctx: Request) -> List[str]:
+async def get_recents(ctx: Request, response: Response) -> List[str]:
     '''
     Retrieves the 10 most recently converted files.
     '''
 
-    cur = ctx.app.state.db.music.files.find(
-        {'$or': [{'metadata.pending': {'$exists': False}}, {'metadata.pending': False}]})
-    cur.sort(('uploadDate'), -1)
-    cur.limit(10)
-
-    results = []
-
-    async for doc in cur:
-        results.append(str(doc['_id']))
+    # Changes at most as often as files are converted, let the reverse proxy serve most of these
+    response.headers['Cache-Control'] = 'public, max-age=5'
 
-    return results
+    return await ctx.app.state.recents.get(ctx.app.state.db)
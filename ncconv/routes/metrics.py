@@ -0,0 +1,26 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# metrics.py - Exposes the Prometheus metrics.
+
+
+from fastapi import APIRouter, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from ncconv.metrics import exposition
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get('/metrics', include_in_schema=False)
+async def metrics(request: Request) -> Response:
+    '''
+    Metrics of this instance in the Prometheus text format. Should not be reachable from outside, restrict it in NGINX
+    '''
+    # CONTENT_TYPE_LATEST already has a charset, which media_type would add again
+    return Response(await exposition(request.app.state.db), headers={'Content-Type': CONTENT_TYPE_LATEST})
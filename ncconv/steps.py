@@ -0,0 +1,89 @@
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# steps.py - Lets what the workers do with MongoDB be written once, and run either
+# with pymongo by the thread workers or with Motor by the asyncio workers.
+
+
+import asyncio
+from inspect import isawaitable
+from itertools import islice
+from typing import Any, Callable, Generator, TypeVar
+
+
+T = TypeVar('T')
+
+# A step generator: yields each call it makes to pymongo or Motor and is sent back its result. pymongo returns the
+# result right away, Motor returns something to await for it. Whatever the generator returns is the result of the run.
+Steps = Generator[Any, Any, T]
+
+
+class blocking:
+    '''
+    A step that can't be run on the event loop, like a filesystem call. run_steps_async runs it in a thread.
+    '''
+
+    def __init__(self, fn: Callable, *args):
+        self.fn, self.args = fn, args
+
+    def __call__(self):
+        return self.fn(*self.args)
+
+
+def run_steps(steps: Steps[T]) -> T:
+    '''
+    Runs a step generator that was given a pymongo database, and returns its result.
+    '''
+    send, value = steps.send, None
+
+    while True:
+        try:
+            step = send(value)
+        except StopIteration as e:
+            return e.value
+
+        try:
+            value, send = step() if isinstance(step, blocking) else step, steps.send
+        except BaseException as e:
+            value, send = e, steps.throw
+
+
+async def run_steps_async(steps: Steps[T]) -> T:
+    '''
+    Runs a step generator that was given a Motor database, and returns its result. What goes wrong while a step is
+    awaited, including the task being cancelled, is raised inside the generator, just like pymongo would.
+    '''
+    send, value = steps.send, None
+
+    while True:
+        try:
+            step = send(value)
+        except StopIteration as e:
+            return e.value
+
+        try:
+            if isinstance(step, blocking):
+                value = await asyncio.to_thread(step)
+            elif isawaitable(step):
+                value = await step
+            else:
+                value = step
+
+            send = steps.send
+        except BaseException as e:
+            value, send = e, steps.throw
+
+
+def batch(cursor, n: int) -> Any:
+    '''
+    The step that reads the next n documents of a pymongo or Motor cursor, fewer at its end.
+    '''
+    if hasattr(cursor, 'to_list'):
+        return cursor.to_list(n)
+
+    return list(islice(cursor, n))
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+# Copyright (C) 2022  Aurora McGinnis
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation using version 3 of the License ONLY.
+#
+# See LICENSE.txt for more information.
+#
+# worker.py - Runs conversion workers without the HTTP server, so that
+# conversions can be scaled separately from it.
+
+
+from argparse import ArgumentParser
+from queue import SimpleQueue
+import shutil
+import signal
+import sys
+
+from pymongo import MongoClient
+from sentry_sdk import init as sentry_init
+
+from ncconv.config import FFMPEG_EXEC, FFPROBE_EXEC, FFMPEG_THREADS, FFMPEG_WORKERS, MONGO_URI, MONGO_DB, PREVIEW_WORKERS, SENTRY_DSN, VERSION, WORKER_ENGINE
+from ncconv.aworkers import afftask
+from ncconv.cworkers import fftask
+from ncconv.metrics import serve as serve_metrics
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        prog='python3 -m ncconv.worker', description='Converts files queued by the application server.')
+    parser.add_argument('-w', '--workers', type=int, default=FFMPEG_WORKERS,
+                        help='How many files to convert at the same time (default: %(default)s)')
+    parser.add_argument('-t', '--threads', type=int, default=FFMPEG_THREADS,
+                        help='How many threads the conversions may use between them (default: %(default)s)')
+    parser.add_argument('-p', '--preview-workers', type=int, default=PREVIEW_WORKERS,
+                        help='How many previews to convert at the same time, 0 for none (default: %(default)s)')
+    parser.add_argument('-m', '--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this port (default: don\'t)')
+    args = parser.parse_args()
+
+    if args.workers < 1 or args.threads < 1:
+        parser.error('--workers and --threads must be at least 1')
+
+    if args.preview_workers < 0:
+        parser.error('--preview-workers can\'t be negative')
+
+    if WORKER_ENGINE not in ('threads', 'asyncio'):
+        print(f'FATAL: Unknown WORKER_ENGINE {WORKER_ENGINE}, use threads or asyncio.')
+        sys.exit(1)
+
+    # check that ffmpeg is present
+    if not shutil.which(FFMPEG_EXEC) or not shutil.which(FFPROBE_EXEC):
+        print('FATAL: ffmpeg or ffprobe was not found in PATH. Install them and try again.')
+        sys.exit(1)
+
+    if SENTRY_DSN:
+        sentry_init(dsn=SENTRY_DSN, release=VERSION)
+
+    # SimpleQueue, since put is called from a signal handler, which Queue's lock isn't safe for
+    q = SimpleQueue()
+
+    def drain(signum, frame):
+        print('Waiting for conversions in progress to finish.')
+        q.put(1)  # Tell fftask to stop claiming jobs
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    print(f'Converting with {args.workers} workers, {args.threads} threads and {args.preview_workers} preview workers.')
+
+    # Both return once every worker is done. The asyncio workers connect with Motor on their event loop.
+    if WORKER_ENGINE == 'asyncio':
+        afftask(q, None, args.workers, args.threads, args.preview_workers)
+    else:
+        # sync db handle
+        db = MongoClient(MONGO_URI)[MONGO_DB]
+        fftask(q, db, args.workers, args.threads, args.preview_workers)